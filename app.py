@@ -1,6 +1,9 @@
 from app import create_app
 
-app = create_app()
+# процессы пула хэширования (spawn) заново импортируют главный модуль как __mp_main__,
+# приложение в них подниматься не должно
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -1,38 +1,156 @@
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from dotenv import load_dotenv
+from app.cache import TTLCache
+from app.storage import RoutingSession
+from app.ratelimit import parse_limits, DEFAULT_LIMITS
 import os
 
 load_dotenv()
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
+user_cache = TTLCache()
 
 def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default_secret')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///instance/luffychat.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['STORAGE_PROFILE'] = os.getenv('STORAGE_PROFILE', 'default')
+    app.config['REPLICA_DATABASE_URL'] = os.getenv('REPLICA_DATABASE_URL', '')
+    app.config['REPLICA_SYNC_INTERVAL'] = int(os.getenv('REPLICA_SYNC_INTERVAL', 0))
+    app.config['REPLICA_READ_AFTER_WRITE'] = int(os.getenv('REPLICA_READ_AFTER_WRITE', max(5, 2 * app.config['REPLICA_SYNC_INTERVAL'])))
+    app.config['HISTORY_PAGE_SIZE'] = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+    app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 10000))
+    app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))
+    app.config['DIRECTORY_PAGE_SIZE'] = int(os.getenv('DIRECTORY_PAGE_SIZE', 50))
+    app.config['DIRECTORY_CACHE_TTL'] = int(os.getenv('DIRECTORY_CACHE_TTL', 30))
+    app.config['SEARCH_LIMIT'] = int(os.getenv('SEARCH_LIMIT', 20))
+    app.config['ARCHIVE_DIR'] = os.getenv('ARCHIVE_DIR', '')
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+    app.config['ARCHIVE_INTERVAL'] = int(os.getenv('ARCHIVE_INTERVAL', 0))
+    app.config['HASH_WORKERS'] = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))
+    app.config['HASH_QUEUE_LIMIT'] = int(os.getenv('HASH_QUEUE_LIMIT', 64))
+    app.config['HASH_TIMEOUT'] = float(os.getenv('HASH_TIMEOUT', 30))
+    app.config['PROVISIONING_TOKEN'] = os.getenv('PROVISIONING_TOKEN', '')
+    app.config['RATE_LIMITS'] = parse_limits(os.getenv('RATE_LIMITS', DEFAULT_LIMITS))
+    app.config['SSE_HEARTBEAT'] = int(os.getenv('SSE_HEARTBEAT', 15))
+    app.config['SEND_BATCHING'] = os.getenv('SEND_BATCHING', '0') == '1'
+    app.config['SEND_BATCH_SIZE'] = int(os.getenv('SEND_BATCH_SIZE', 100))
+    app.config['SEND_BATCH_DELAY'] = float(os.getenv('SEND_BATCH_DELAY', 0))
+    app.config['SEND_BATCH_TIMEOUT'] = float(os.getenv('SEND_BATCH_TIMEOUT', 10))
+    app.config['MESSAGE_BUS'] = os.getenv('MESSAGE_BUS', 'memory')
+    app.config['MESSAGE_BUS_DIR'] = os.getenv('MESSAGE_BUS_DIR', '')
+    app.config['GATEWAY_URL'] = os.getenv('GATEWAY_URL', '')
+    app.config['GATEWAY_ALLOWED_ORIGINS'] = [o for o in os.getenv('GATEWAY_ALLOWED_ORIGINS', '').split(',') if o]
+    app.config['GATEWAY_DB_THREADS'] = int(os.getenv('GATEWAY_DB_THREADS', 8))
+    app.config['GATEWAY_QUEUE_SIZE'] = int(os.getenv('GATEWAY_QUEUE_SIZE', 100))
+    app.config['GATEWAY_MAX_MESSAGE'] = int(os.getenv('GATEWAY_MAX_MESSAGE', 64 * 1024))
+    if app.config['GATEWAY_URL'] and app.config['MESSAGE_BUS'] != 'socket':
+        # шлюз - отдельный процесс, без общей шины HTTP /send и WebSocket не видят событий друг друга
+        raise ValueError('GATEWAY_URL requires MESSAGE_BUS=socket')
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN', '')
+    app.config['SLOW_REQUEST_MS'] = int(os.getenv('SLOW_REQUEST_MS', 500))
 
+    from app import storage
+    storage.configure(app)
     db.init_app(app)
+    storage.install_pragmas(app, db)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
 
+    from app.bus import message_bus
+    message_bus.init_app(app)
+
+    from app.writer import message_writer
+    message_writer.init_app(app)
+
+    from app.hashing import hash_pool
+    hash_pool.init_app(app)
+
+    from app.metrics import request_metrics
+    request_metrics.init_app(app)
+
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+
     from app.models import User
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        # в кэше лежит отсоединённый от сессии объект, в запрос отдаём его копию без SQL
+        user_id = int(user_id)
+        cached = user_cache.get(user_id)
+        if cached is None:
+            cached = db.session.get(User, user_id)
+            if cached is None:
+                return None
+            db.session.expunge(cached)
+            user_cache.set(user_id, cached)
+        return db.session.merge(cached, load=False)
 
     from app.auth import auth_bp
-    from app.chat import chat_bp
+    from app.chat import chat_bp, directory_cache
     from app.groups import groups_bp
 
+    directory_cache.ttl = app.config['DIRECTORY_CACHE_TTL']
+
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(chat_bp, url_prefix='/')
     app.register_blueprint(groups_bp, url_prefix='/groups')
 
+    from app.migrations import upgrade
+    from app import search
+
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        upgrade(force_backfill=True)
+
+    @app.cli.command('search-rebuild')
+    def search_rebuild():
+        search.rebuild_all()
+
+    @app.cli.command('inbox-rebuild')
+    def inbox_rebuild():
+        from app import inbox
+        inbox.rebuild()
+
+    @app.cli.command('archive-messages')
+    def archive_messages():
+        from app import archive
+        print(f'archived {archive.archive_messages()} messages')
+
+    @app.cli.command('import-users')
+    @click.argument('path')
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None)
+    def import_users(path, fmt):
+        from app import provisioning
+        fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+        with open(path, encoding='UTF-8', newline='') as f:
+            rows = provisioning.parse_csv(f) if fmt == 'csv' else provisioning.parse_ndjson(f)
+        result = provisioning.import_users(rows)
+        for error in result['errors']:
+            print(f"row {error['row']} ({error['username']}): {error['error']}")
+        print(f"created {result['created']} users, {len(result['errors'])} errors")
+
+    @app.cli.command('replica-sync')
+    def replica_sync():
+        storage.sync_replica(app, db)
+
     with app.app_context():
         db.create_all()
+        upgrade()
+        search.install()
+
+    if app.config['ARCHIVE_INTERVAL']:
+        from app import archive
+        archive.start_archiver(app, app.config['ARCHIVE_INTERVAL'])
+
+    if app.config['REPLICA_DATABASE_URL'] and app.config['REPLICA_SYNC_INTERVAL']:
+        # воркеры стартуют почти одновременно: первый копирует, остальные дожидаются его копии
+        storage.sync_replica(app, db, max_age=app.config['REPLICA_SYNC_INTERVAL'])
+        storage.start_replica_sync(app, db, app.config['REPLICA_SYNC_INTERVAL'])
 
     return app
\ No newline at end of file
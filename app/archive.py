@@ -0,0 +1,140 @@
+import fcntl
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db, search
+from app.models import Message, ArchiveSegment, ArchiveEntry
+
+class ArchivedMessage:
+    # те же поля, что читают history.serialize и шаблоны
+    def __init__(self, data):
+        self.id = data['id']
+        self.content = data['content']
+        self.sender_id = data['sender_id']
+        self.receiver_id = data['receiver_id']
+        self.group_id = data['group_id']
+        self.conversation_key = data['conversation_key']
+        self.timestamp = datetime.fromisoformat(data['timestamp'])
+
+def archive_dir():
+    return current_app.config['ARCHIVE_DIR'] or os.path.join(current_app.instance_path, 'archive')
+
+def encode(messages):
+    lines = [json.dumps({
+        'id': m.id,
+        'content': m.content,
+        'sender_id': m.sender_id,
+        'receiver_id': m.receiver_id,
+        'group_id': m.group_id,
+        'conversation_key': m.conversation_key,
+        'timestamp': m.timestamp.isoformat()
+    }, ensure_ascii=False) for m in messages]
+    return gzip.compress('\n'.join(lines).encode())
+
+def read_block(segment):
+    with open(os.path.join(archive_dir(), segment.path), 'rb') as f:
+        f.seek(segment.offset)
+        data = gzip.decompress(f.read(segment.length))
+    return [ArchivedMessage(json.loads(line)) for line in data.decode().split('\n')]
+
+def older(scope, before_id, limit):
+    # сообщения из сегментов, от новых к старым; сегменты выбираются по индексу (диалог, last_id)
+    query = ArchiveSegment.query.filter_by(**scope)
+    if before_id:
+        query = query.filter(ArchiveSegment.first_id < before_id)
+    result = []
+    for segment in query.order_by(ArchiveSegment.last_id.desc()):
+        messages = [m for m in read_block(segment) if not before_id or m.id < before_id]
+        result += messages[::-1]
+        if len(result) >= limit:
+            break
+    return result[:limit]
+
+def load(ids):
+    # архивные сообщения по id, по одному чтению блока на сегмент
+    wanted = set(ids)
+    if not wanted:
+        return []
+    segment_ids = db.session.query(ArchiveEntry.segment_id).filter(ArchiveEntry.id.in_(wanted)).distinct()
+    result = []
+    for segment in ArchiveSegment.query.filter(ArchiveSegment.id.in_(segment_ids)):
+        result += [m for m in read_block(segment) if m.id in wanted]
+    return result
+
+def blocks():
+    for segment in ArchiveSegment.query.order_by(ArchiveSegment.id).yield_per(100):
+        yield segment, read_block(segment)
+
+def write_batch(messages, path):
+    # каждый диалог пачки - отдельный gzip-блок в конце append-only файла
+    by_scope = {}
+    for m in messages:
+        key = ('conversation_key', m.conversation_key) if m.conversation_key else ('group_id', m.group_id)
+        by_scope.setdefault(key, []).append(m)
+
+    full_path = os.path.join(archive_dir(), path)
+    segments = []
+    with open(full_path, 'ab') as f:
+        for (column, value), chunk in by_scope.items():
+            block = encode(chunk)
+            offset = f.tell()
+            f.write(block)
+            segments.append((ArchiveSegment(
+                first_id=chunk[0].id, last_id=chunk[-1].id, count=len(chunk),
+                path=path, offset=offset, length=len(block), **{column: value}
+            ), chunk))
+        f.flush()
+        os.fsync(f.fileno())
+    return segments
+
+def archive_messages(older_than_days=None, batch_size=10000):
+    # переносит сообщения старше older_than_days из message в сегменты, возвращает их число
+    older_than_days = older_than_days or current_app.config['ARCHIVE_AFTER_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    os.makedirs(archive_dir(), exist_ok=True)
+    path = datetime.utcnow().strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}.seg'
+    total = 0
+    while True:
+        # id растут вместе со временем, поэтому старые строки - в начале таблицы
+        messages = Message.query.filter(Message.timestamp < cutoff).order_by(Message.id).limit(batch_size).all()
+        messages = [m for m in messages if m.conversation_key or m.group_id]
+        if not messages:
+            return total
+        written = write_batch(messages, path)
+        db.session.add_all(segment for segment, _ in written)
+        db.session.flush()
+        db.session.execute(ArchiveEntry.__table__.insert(), [
+            {'id': m.id, 'segment_id': segment.id} for segment, chunk in written for m in chunk
+        ])
+        Message.query.filter(Message.id.in_([m.id for m in messages])).delete(synchronize_session=False)
+        # триггер удаления убрал их из message_search - возвращаем, чтобы поиск видел архив
+        search.index_archived(messages)
+        db.session.commit()
+        total += len(messages)
+
+def run_locked(app):
+    # в нескольких воркерах архивирует только тот, кто взял блокировку
+    with app.app_context():
+        os.makedirs(archive_dir(), exist_ok=True)
+        with open(os.path.join(archive_dir(), 'archiver.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            return archive_messages()
+
+def start_archiver(app, interval):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                moved = run_locked(app)
+                if moved:
+                    app.logger.info('archived %d messages', moved)
+            except Exception:
+                app.logger.exception('archiver failed')
+    threading.Thread(target=loop, name='archiver', daemon=True).start()
@@ -1,8 +1,11 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+import hmac
+from flask import Blueprint, current_app, render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from app import db
+from app import db, user_cache
 from app.models import User
+from app.chat import directory_cache
+from app.hashing import hash_pool, PoolBusy
+from app import provisioning
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -24,10 +27,15 @@ def register():
             flash('Nickname already taken')
             return redirect(url_for('auth.register'))
 
-        hashed = generate_password_hash(password)
+        try:
+            hashed = hash_pool.hash(password)
+        except PoolBusy:
+            flash('Server is busy, please try again')
+            return render_template('register.html'), 503
         user = User(username=username, email=email, nickname=nickname, password_hash=hashed)
         db.session.add(user)
         db.session.commit()
+        directory_cache.clear()
         flash('Account created! Please login.')
         return redirect(url_for('auth.login'))
     return render_template('register.html')
@@ -38,14 +46,41 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            valid = user is not None and hash_pool.check(user.password_hash, password)
+        except PoolBusy:
+            flash('Server is busy, please try again')
+            return render_template('login.html'), 503
+        if valid:
             login_user(user)
             return redirect(url_for('chat.index'))
         flash('Invalid credentials')
     return render_template('login.html')
 
+@auth_bp.route('/bulk', methods=['POST'])
+def bulk_import():
+    # массовое создание аккаунтов, доступ по токену из .env
+    token = current_app.config['PROVISIONING_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return jsonify({'error': 'Forbidden'}), 403
+
+    if request.mimetype == 'text/csv':
+        rows = provisioning.parse_csv(request.get_data(as_text=True).splitlines())
+    elif request.mimetype == 'application/x-ndjson':
+        rows = provisioning.parse_ndjson(request.get_data(as_text=True).splitlines())
+    else:
+        data = request.get_json(silent=True)
+        rows = data.get('users') if isinstance(data, dict) else data
+    if not isinstance(rows, list):
+        return jsonify({'error': 'Expected a list of users'}), 400
+    try:
+        return jsonify(provisioning.import_users(rows))
+    except PoolBusy:
+        return jsonify({'error': 'Another import is running'}), 503
+
 @auth_bp.route('/logout')
 @login_required
 def logout():
+    user_cache.pop(current_user.id)
     logout_user()
     return redirect(url_for('auth.login'))
\ No newline at end of file
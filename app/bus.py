@@ -0,0 +1,153 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+from app.events import subscribers, RESYNC
+
+log = logging.getLogger(__name__)
+
+class MemoryBus:
+    # один процесс: доставляем сразу в локальный реестр подписчиков
+    def start(self):
+        pass
+
+    def publish(self, user_ids, event):
+        subscribers.publish(user_ids, event)
+
+class SocketBus:
+    # несколько воркеров на одной машине: каждый слушает свой unix datagram сокет
+    # в общей папке, publish рассылает событие во все найденные сокеты
+    max_datagram = 65000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        # peer -> что он пропустил: служебные события целиком, по сообщениям - только получатели
+        self.backlog = {}
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.pid = os.getpid()
+            self.path = os.path.join(self.directory, f'worker-{self.pid}.sock')
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self.receiver.bind(self.path)
+            self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # короткое ожидание сглаживает всплески, зависший сосед не держит запрос дольше
+            self.sender.settimeout(0.05)
+            threading.Thread(target=self.listen, name='bus-listener', daemon=True).start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.path and self.pid == os.getpid() and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def listen(self):
+        while True:
+            data = self.receiver.recv(self.max_datagram)
+            # ошибка в хуке или битый пакет не должны останавливать доставку в этом воркере
+            try:
+                packet = json.loads(data)
+                subscribers.publish(packet['user_ids'], packet['event'])
+            except Exception:
+                log.exception('bus: failed to deliver packet')
+
+    def peers(self):
+        return [p for p in glob.glob(os.path.join(self.directory, 'worker-*.sock')) if p != self.path]
+
+    def packets(self, user_ids, event):
+        # событие, которое не влезает в датаграмму, заменяем на RESYNC: клиенты дочитают его по after_id;
+        # длинный список получателей режем пополам, пока пакеты не влезут
+        if len(json.dumps({'user_ids': user_ids[:1], 'event': event}).encode()) > self.max_datagram:
+            log.warning('bus event %s too large, sending resync instead', event.get('type'))
+            event = RESYNC
+        data = json.dumps({'user_ids': user_ids, 'event': event}).encode()
+        if len(data) <= self.max_datagram or len(user_ids) <= 1:
+            return [data]
+        middle = len(user_ids) // 2
+        return self.packets(user_ids[:middle], event) + self.packets(user_ids[middle:], event)
+
+    def send(self, peer, packets):
+        # True - всё отправлено; False - сосед не успевает читать
+        for data in packets:
+            try:
+                self.sender.sendto(data, peer)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # воркер умер, сокет остался
+                self.backlog.pop(peer, None)
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+                return True
+            except (BlockingIOError, TimeoutError):
+                self.dropped += 1
+                return False
+        return True
+
+    def remember(self, peer, user_ids, event):
+        missed = self.backlog.setdefault(peer, {'user_ids': set(), 'events': []})
+        if event.get('type') == 'message':
+            missed['user_ids'].update(user_ids)
+        else:
+            # membership-события нужны хукам соседа для сброса кэшей, их сохраняем целиком
+            missed['events'].append((list(user_ids), event))
+
+    def flush(self, peer):
+        # сначала досылаем пропущенное соседу, чтобы RESYNC пришёл раньше новых событий
+        missed = self.backlog.pop(peer)
+        packets = [p for ids, event in missed['events'] for p in self.packets(ids, event)]
+        if missed['user_ids']:
+            packets += self.packets(sorted(missed['user_ids']), RESYNC)
+        if not self.send(peer, packets):
+            self.backlog[peer] = missed
+            return False
+        return True
+
+    def publish(self, user_ids, event):
+        self.start()
+        user_ids = list(user_ids)
+        subscribers.publish(user_ids, event)
+        packets = self.packets(user_ids, event)
+        with self.lock:
+            for peer in self.peers():
+                if peer in self.backlog and not self.flush(peer):
+                    self.remember(peer, user_ids, event)
+                elif not self.send(peer, packets):
+                    self.remember(peer, user_ids, event)
+
+class MessageBus:
+    def __init__(self):
+        self.backend = MemoryBus()
+
+    def init_app(self, app):
+        kind = app.config['MESSAGE_BUS']
+        if kind == 'socket':
+            self.backend = SocketBus(app.config['MESSAGE_BUS_DIR'] or os.path.join(app.instance_path, 'bus'))
+        elif kind == 'memory':
+            self.backend = MemoryBus()
+        else:
+            raise ValueError(f'Unknown MESSAGE_BUS: {kind}')
+        self.start()
+
+    def start(self):
+        # сокет привязан к pid: воркер, форкнутый после create_app, открывает свой при первой подписке
+        self.backend.start()
+
+    def publish(self, user_ids, event):
+        self.backend.publish(user_ids, event)
+
+message_bus = MessageBus()
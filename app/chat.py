@@ -1,68 +1,184 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for
+from flask import Blueprint, Response, current_app, render_template, request, jsonify, redirect, url_for
 from flask_login import login_required, current_user
-from app import db
-from app.models import User, Message, Group, GroupMember
+from app import db, history, inbox, membership
+from app import search as search_index
+from app.bus import message_bus
+from app.cache import TTLCache
+from app.writer import message_writer, WriterBusy
+from app.storage import replica_read, primary_read, note_write, id_arg, MAX_ID
+from app.ratelimit import rate_limit
+from app.events import message_event, event_stream
+from app.models import User, Message, conversation_key
 from datetime import datetime
 
 chat_bp = Blueprint('chat', __name__)
 
+directory_cache = TTLCache(maxsize=256, ttl=30)
+
+def directory_page(after_id):
+    # страница общая для всех, себя вырезаем уже при выдаче
+    def load():
+        size = current_app.config['DIRECTORY_PAGE_SIZE']
+        with primary_read():
+            rows = User.query.with_entities(User.id, User.username, User.nickname).filter(
+                User.id > after_id
+            ).order_by(User.id).limit(size + 1).all()
+        users = [{'id': r.id, 'username': r.username, 'nickname': r.nickname} for r in rows[:size]]
+        return {'users': users, 'next_after_id': users[-1]['id'] if users else after_id, 'has_more': len(rows) > size}
+    page = directory_cache.get_or_load(after_id, load)
+    return dict(page, users=[u for u in page['users'] if u['id'] != current_user.id])
+
 @chat_bp.route('/')
 @login_required
+@replica_read
 def index():
-    users = User.query.filter(User.id != current_user.id).all()
-    groups = Group.query.join(GroupMember).filter(GroupMember.user_id == current_user.id).all()
-    return render_template('index.html', users=users, groups=groups)
+    directory = directory_page(0)
+    groups = membership.user_groups(current_user.id)
+    return render_template('index.html', directory=directory, groups=groups)
+
+@chat_bp.route('/directory')
+@login_required
+@replica_read
+def directory():
+    return jsonify(directory_page(id_arg(request.args, 'after_id', 0)))
 
 @chat_bp.route('/search')
 @login_required
+@replica_read
+@rate_limit('search')
 def search():
-    query = request.args.get('q', '')
-    users = User.query.filter(
-        User.id != current_user.id,
-        (User.username.contains(query) | User.nickname.contains(query))
-    ).all()
-    return jsonify([{'id': u.id, 'username': u.username, 'nickname': u.nickname} for u in users])
+    users = search_index.find_users(request.args.get('q', ''), exclude_id=current_user.id)
+    response = jsonify([{'id': u.id, 'username': u.username, 'nickname': u.nickname} for u in users])
+    response.add_etag()
+    return response.make_conditional(request)
 
 @chat_bp.route('/chat/<int:user_id>')
 @login_required
 def chat_with_user(user_id):
     other = User.query.get_or_404(user_id)
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.timestamp).all()
-    return render_template('chat.html', user=other, messages=messages, chat_type='user')
+    inbox.mark_read(current_user.id, peer_id=user_id)
+    db.session.commit()
+    messages, has_more = history.latest(history.dm_scope(current_user.id, user_id))
+    return render_template('chat.html', user=other, messages=messages, senders=history.sender_names(messages), has_more=has_more, chat_type='user')
+
+def stage_message(sender_id, sender_name, content, receiver_id=None, group_id=None):
+    # пишет сообщение и сводку в текущую транзакцию, commit делает вызывающий
+    msg = Message(
+        content=content,
+        sender_id=sender_id,
+        receiver_id=int(receiver_id) if receiver_id else None,
+        group_id=int(group_id) if group_id else None,
+        conversation_key=conversation_key(sender_id, receiver_id) if receiver_id else None
+    )
+    db.session.add(msg)
+    db.session.flush()
+    inbox.record_message(msg)
+
+    if msg.group_id:
+        recipients = membership.member_ids(msg.group_id)
+    else:
+        recipients = [msg.sender_id, msg.receiver_id]
+    return message_event(msg, sender_name), recipients
+
+def store_message(sender, content, receiver_id=None, group_id=None):
+    # общий путь записи для /send и WebSocket-шлюза, возвращает разосланное событие
+    if message_writer.enabled:
+        # запись идёт в потоке писателя, сессия запроса её не видит
+        note_write()
+        return message_writer.submit(sender.id, sender.nickname, content, receiver_id, group_id)
+    event, recipients = stage_message(sender.id, sender.nickname, content, receiver_id, group_id)
+    db.session.commit()
+    message_bus.publish(recipients, event)
+    return event
+
+def parse_target(receiver_id, group_id):
+    # получатель сообщения: ровно один из receiver_id и group_id, оба - положительные целые
+    ids = []
+    for value in (receiver_id, group_id):
+        value = str(value) if value not in (None, '') else ''
+        if value and not (value.isdecimal() and len(value) <= 19 and 0 < int(value) <= MAX_ID):
+            return None, 'Invalid receiver_id or group_id'
+        ids.append(int(value) if value else None)
+    if (ids[0] is None) == (ids[1] is None):
+        return None, 'Exactly one of receiver_id and group_id is required'
+    return ids, None
 
 @chat_bp.route('/send', methods=['POST'])
 @login_required
+@rate_limit('send')
 def send_message():
-    receiver_id = request.form.get('receiver_id')
-    group_id = request.form.get('group_id')
     content = request.form.get('content')
     
     if not content:
         return jsonify({'error': 'Empty message'}), 400
+    target, error = parse_target(request.form.get('receiver_id'), request.form.get('group_id'))
+    if error:
+        return jsonify({'error': error}), 400
+    receiver_id, group_id = target
+    if group_id and not membership.is_member(current_user.id, group_id):
+        return jsonify({'error': 'Not a member of this group'}), 403
 
-    msg = Message(
-        content=content,
-        sender_id=current_user.id,
-        receiver_id=int(receiver_id) if receiver_id else None,
-        group_id=int(group_id) if group_id else None
-    )
-    db.session.add(msg)
-    db.session.commit()
-    return jsonify({'status': 'ok', 'timestamp': msg.timestamp.isoformat()})
+    try:
+        event = store_message(current_user, content, receiver_id, group_id)
+    except WriterBusy:
+        return jsonify({'error': 'Server is busy, please try again'}), 503
+    return jsonify({'status': 'ok', 'id': event['id'], 'timestamp': event['timestamp']})
 
 @chat_bp.route('/messages/<int:user_id>')
 @login_required
+@replica_read
+@rate_limit('poll')
 def get_messages(user_id):
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.timestamp).all()
-    return jsonify([{
-        'content': m.content,
-        'sender_id': m.sender_id,
-        'timestamp': m.timestamp.isoformat(),
-        'is_mine': m.sender_id == current_user.id
-    } for m in messages])
\ No newline at end of file
+    # after_id - новые сообщения для опроса, before_id - страница истории при прокрутке вверх
+    return history.page_response(history.dm_scope(current_user.id, user_id), request.args)
+
+@chat_bp.route('/messages/search')
+@login_required
+@rate_limit('search')
+def search_messages():
+    if not search_index.fts_enabled():
+        return jsonify({'error': 'Message search is not available'}), 501
+    before_id = id_arg(request.args, 'before_id')
+    messages, has_more = search_index.find_messages(request.args.get('q', ''), current_user.id, before_id)
+    results = history.serialize(messages)
+    for item, m in zip(results, messages):
+        item['receiver_id'] = m.receiver_id
+        item['group_id'] = m.group_id
+    return jsonify({
+        'messages': results,
+        'next_before_id': messages[-1].id if messages else None,
+        'has_more': has_more
+    })
+
+@chat_bp.route('/inbox')
+@login_required
+@replica_read
+def inbox_page():
+    before = request.args.get('before')
+    cursor = inbox.parse_cursor(before) if before else None
+    if before and not cursor:
+        return jsonify({'error': 'Invalid before cursor'}), 400
+    return jsonify(inbox.page(current_user.id, cursor, current_app.config['HISTORY_PAGE_SIZE']))
+
+@chat_bp.route('/read', methods=['POST'])
+@login_required
+def mark_read():
+    peer_id = id_arg(request.form, 'peer_id')
+    group_id = id_arg(request.form, 'group_id')
+    last_id = id_arg(request.form, 'last_id')
+    if not (peer_id or group_id) or not last_id:
+        return jsonify({'error': 'peer_id or group_id and last_id are required'}), 400
+    inbox.mark_read(current_user.id, peer_id=peer_id, group_id=group_id, up_to=last_id)
+    db.session.commit()
+    return jsonify({'status': 'ok'})
+
+@chat_bp.route('/stream')
+@login_required
+def stream():
+    # Server-Sent Events: новые сообщения приходят сразу после commit в send_message
+    message_bus.start()
+    generator = event_stream(current_user.id, current_app.config['SSE_HEARTBEAT'])
+    return Response(generator, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
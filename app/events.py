@@ -0,0 +1,83 @@
+import json
+import queue
+import threading
+
+# маркер разрыва: часть событий выброшена, клиент дочитывает пропущенное запросом after_id
+RESYNC = {'type': 'resync'}
+
+class EventQueue(queue.Queue):
+    # очередь подписчика: при переполнении непрочитанные события заменяются одним RESYNC
+    def put_nowait(self, event):
+        try:
+            super().put_nowait(event)
+        except queue.Full:
+            with self.mutex:
+                self.queue.clear()
+                self.queue.append(RESYNC)
+                self.not_empty.notify()
+
+class Subscribers:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._sinks = {}
+        self._hooks = {}
+
+    def on(self, event_type, hook):
+        # hook вызывается на каждое событие этого типа в каждом воркере, независимо от получателей
+        self._hooks.setdefault(event_type, []).append(hook)
+
+    def subscribe(self, user_id, sink=None):
+        # sink - всё, у чего есть put_nowait, не теряющий события молча (EventQueue, мост в asyncio и т.п.)
+        sink = sink or EventQueue(maxsize=self.queue_size)
+        with self._lock:
+            self._sinks.setdefault(user_id, set()).add(sink)
+        return sink
+
+    def unsubscribe(self, user_id, sink):
+        with self._lock:
+            sinks = self._sinks.get(user_id)
+            if sinks:
+                sinks.discard(sink)
+                if not sinks:
+                    del self._sinks[user_id]
+
+    def publish(self, user_ids, event):
+        for hook in self._hooks.get(event.get('type'), ()):
+            hook(event)
+        with self._lock:
+            targets = [s for uid in set(user_ids) for s in self._sinks.get(uid, ())]
+        for sink in targets:
+            sink.put_nowait(event)
+
+    def count(self):
+        with self._lock:
+            return sum(len(s) for s in self._sinks.values())
+
+subscribers = Subscribers()
+
+def message_event(msg, sender_name):
+    return {
+        'type': 'message',
+        'id': msg.id,
+        'content': msg.content,
+        'sender_id': msg.sender_id,
+        'sender_name': sender_name,
+        'receiver_id': msg.receiver_id,
+        'group_id': msg.group_id,
+        'timestamp': msg.timestamp.isoformat()
+    }
+
+def event_stream(user_id, heartbeat=15):
+    sink = subscribers.subscribe(user_id)
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                event = sink.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': ping\n\n'
+                continue
+            yield f"event: {event['type']}\nid: {event.get('id', '')}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        subscribers.unsubscribe(user_id, sink)
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+from itsdangerous import BadSignature
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+from app import db, ratelimit, membership
+from app.bus import message_bus
+from app.chat import store_message, parse_target
+from app.events import subscribers, RESYNC
+from app.models import User
+from app.writer import WriterBusy
+
+log = logging.getLogger(__name__)
+
+class AsyncSink:
+    # мост из потоков Flask (publish) в очередь event loop'а
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+
+    def put_nowait(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # как EventQueue: непрочитанное выбрасываем, клиент дочитает его по after_id
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+class Gateway:
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config['GATEWAY_DB_THREADS'], thread_name_prefix='gateway-db'
+        )
+        self.allowed_origins = app.config['GATEWAY_ALLOWED_ORIGINS']
+
+    def origin_allowed(self, headers):
+        # cookie сессии браузер приложит с любой страницы, поэтому чужой Origin отклоняем (CSWSH).
+        # Без GATEWAY_ALLOWED_ORIGINS пускаем только страницы с того же хоста, что и шлюз;
+        # "*" - явное разрешение для всех. Не браузерные клиенты Origin не присылают
+        origin = headers.get('Origin')
+        if origin is None or '*' in self.allowed_origins:
+            return True
+        if self.allowed_origins:
+            return origin in self.allowed_origins
+        host = urlsplit('//' + headers.get('Host', '')).hostname
+        return bool(host) and urlsplit(origin).hostname == host
+
+    def session_user_id(self, headers):
+        # та же подписанная cookie сессии, что выдаёт Flask-Login при входе
+        cookie = SimpleCookie(headers.get('Cookie', ''))
+        name = self.app.config['SESSION_COOKIE_NAME']
+        if name not in cookie:
+            return None
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        max_age = int(self.app.permanent_session_lifetime.total_seconds())
+        try:
+            session = serializer.loads(cookie[name].value, max_age=max_age)
+        except BadSignature:
+            return None
+        user_id = session.get('_user_id')
+        return int(user_id) if user_id else None
+
+    def save_message(self, user_id, data, receiver_id, group_id):
+        with self.app.app_context():
+            if group_id and not membership.is_member(user_id, group_id):
+                return {'type': 'error', 'ref': data.get('ref'), 'error': 'Not a member of this group'}
+            user = db.session.get(User, user_id)
+            event = store_message(user, data['content'], receiver_id, group_id)
+            return {'type': 'ack', 'ref': data.get('ref'), 'id': event['id'], 'timestamp': event['timestamp']}
+
+    async def handle_send(self, websocket, user_id, data):
+        if not data.get('content'):
+            await websocket.send(json.dumps({'type': 'error', 'ref': data.get('ref'), 'error': 'Empty message'}))
+            return
+        target, error = parse_target(data.get('receiver_id'), data.get('group_id'))
+        if error:
+            await websocket.send(json.dumps({'type': 'error', 'ref': data.get('ref'), 'error': error}))
+            return
+        with self.app.app_context():
+            retry_after = ratelimit.check('send', user_id)
+        if retry_after:
+            await websocket.send(json.dumps({'type': 'error', 'ref': data.get('ref'), 'error': 'Too many requests',
+                                             'retry_after': round(retry_after, 2)}))
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            reply = await loop.run_in_executor(self.executor, self.save_message, user_id, data, *target)
+        except WriterBusy:
+            reply = {'type': 'error', 'ref': data.get('ref'), 'error': 'Server is busy'}
+        except Exception:
+            log.exception('gateway send failed')
+            reply = {'type': 'error', 'ref': data.get('ref'), 'error': 'Send failed'}
+        await websocket.send(json.dumps(reply))
+
+    async def receive(self, websocket, user_id):
+        async for raw in websocket:
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                continue
+            if data.get('type') == 'send':
+                await self.handle_send(websocket, user_id, data)
+
+    async def deliver(self, websocket, sink):
+        try:
+            while True:
+                event = await sink.queue.get()
+                await websocket.send(json.dumps(event))
+        except ConnectionClosed:
+            pass
+
+    async def handler(self, websocket):
+        headers = websocket.request.headers
+        if not self.origin_allowed(headers):
+            await websocket.close(1008, 'Origin not allowed')
+            return
+        user_id = self.session_user_id(headers)
+        if not user_id:
+            await websocket.close(1008, 'Login required')
+            return
+
+        sink = AsyncSink(asyncio.get_running_loop(), self.app.config['GATEWAY_QUEUE_SIZE'])
+        message_bus.start()
+        subscribers.subscribe(user_id, sink)
+        delivery = asyncio.create_task(self.deliver(websocket, sink))
+        try:
+            await self.receive(websocket, user_id)
+        finally:
+            subscribers.unsubscribe(user_id, sink)
+            delivery.cancel()
+
+    async def serve(self, host, port):
+        # без сжатия и с маленькими буферами простаивающее соединение почти ничего не стоит
+        async with serve(
+            self.handler, host, port,
+            compression=None,
+            max_size=self.app.config['GATEWAY_MAX_MESSAGE'],
+            max_queue=4,
+            write_limit=32 * 1024,
+            ping_interval=30,
+            ping_timeout=30
+        ) as server:
+            await server.serve_forever()
+
+def run(app, host='0.0.0.0', port=5001):
+    if app.config['MESSAGE_BUS'] != 'socket':
+        raise ValueError('gateway requires MESSAGE_BUS=socket shared with the HTTP workers')
+    asyncio.run(Gateway(app).serve(host, port))
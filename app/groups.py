@@ -1,7 +1,10 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
-from app import db
-from app.models import Group, GroupMember, User, Message
+from app import db, history, inbox, membership
+from app.bus import message_bus
+from app.storage import replica_read, id_arg, MAX_ID
+from app.ratelimit import rate_limit
+from app.models import Group, GroupMember, User, InboxEntry
 
 groups_bp = Blueprint('groups', __name__)
 
@@ -21,7 +24,16 @@ def create_group():
         # Добавляем создателя в группу
         member = GroupMember(user_id=current_user.id, group_id=group.id)
         db.session.add(member)
+        inbox.add_group_member(current_user.id, group.id)
         db.session.commit()
+        membership.invalidate(group.id, [current_user.id])
+        message_bus.publish([current_user.id], {
+            'type': 'member_added',
+            'group_id': group.id,
+            'group_name': group.name,
+            'user_id': current_user.id,
+            'nickname': current_user.nickname
+        })
         
         flash(f'Group "{name}" created!')
         return redirect(url_for('chat.index'))
@@ -31,13 +43,16 @@ def create_group():
 @login_required
 def view_group(group_id):
     group = Group.query.get_or_404(group_id)
-    if not GroupMember.query.filter_by(user_id=current_user.id, group_id=group_id).first():
+    if not membership.is_member(current_user.id, group_id):
         flash('You are not a member of this group')
         return redirect(url_for('chat.index'))
     
-    messages = Message.query.filter_by(group_id=group_id).order_by(Message.timestamp).all()
-    members = User.query.join(GroupMember).filter(GroupMember.group_id == group_id).all()
-    return render_template('group.html', group=group, messages=messages, members=members)
+    # commit раньше чтения истории: иначе он сбросит загруженные сообщения и шаблон перечитает каждое
+    inbox.mark_read(current_user.id, group_id=group_id)
+    db.session.commit()
+    messages, has_more = history.latest(history.group_scope(group_id))
+    members = membership.members_page(group_id)
+    return render_template('group.html', group=group, messages=messages, senders=history.sender_names(messages), has_more=has_more, members=members)
 
 @groups_bp.route('/<int:group_id>/invite', methods=['POST'])
 @login_required
@@ -51,22 +66,169 @@ def invite_to_group(group_id):
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    if GroupMember.query.filter_by(user_id=user_id, group_id=group_id).first():
+    if membership.is_member(user.id, group_id):
         return jsonify({'error': 'User already in group'}), 400
     
-    member = GroupMember(user_id=user_id, group_id=group_id)
+    member = GroupMember(user_id=user.id, group_id=group_id)
     db.session.add(member)
+    inbox.add_group_member(user.id, group_id)
     db.session.commit()
+
+    membership.invalidate(group_id, [user.id])
+    message_bus.publish(membership.member_ids(group_id), {
+        'type': 'member_added',
+        'group_id': group.id,
+        'group_name': group.name,
+        'user_id': user.id,
+        'nickname': user.nickname
+    })
     return jsonify({'status': 'ok'})
 
 @groups_bp.route('/<int:group_id>/messages')
 @login_required
+@replica_read
+@rate_limit('poll')
 def group_messages(group_id):
-    messages = Message.query.filter_by(group_id=group_id).order_by(Message.timestamp).all()
-    return jsonify([{
-        'content': m.content,
-        'sender_id': m.sender_id,
-        'sender_name': User.query.get(m.sender_id).nickname,
-        'timestamp': m.timestamp.isoformat(),
-        'is_mine': m.sender_id == current_user.id
-    } for m in messages])
\ No newline at end of file
+    if not membership.is_member(current_user.id, group_id):
+        return jsonify({'error': 'Not a member of this group'}), 403
+    return history.page_response(history.group_scope(group_id), request.args)
+
+@groups_bp.route('/<int:group_id>/leave', methods=['POST'])
+@login_required
+def leave_group(group_id):
+    if not membership.is_member(current_user.id, group_id):
+        return jsonify({'error': 'Not a member of this group'}), 400
+    GroupMember.query.filter_by(user_id=current_user.id, group_id=group_id).delete()
+    InboxEntry.query.filter_by(user_id=current_user.id, group_id=group_id).delete()
+    db.session.commit()
+
+    recipients = membership.member_ids(group_id)
+    membership.invalidate(group_id, [current_user.id])
+    message_bus.publish(recipients, {
+        'type': 'member_removed',
+        'group_id': group_id,
+        'user_id': current_user.id
+    })
+    return jsonify({'status': 'ok'})
+
+@groups_bp.route('/<int:group_id>/members')
+@login_required
+@replica_read
+def group_members(group_id):
+    if not membership.is_member(current_user.id, group_id):
+        return jsonify({'error': 'Not a member of this group'}), 403
+    return jsonify(membership.members_page(group_id, id_arg(request.args, 'after_id', 0)))
+
+BULK_CHUNK = 500
+BULK_LIMIT = 1000
+
+def parse_user_id(ref):
+    # число или строка из десятичных цифр; str.isdigit пропускает '²', на котором падает int
+    if isinstance(ref, str) and ref.isdecimal():
+        ref = int(ref)
+    if isinstance(ref, int) and not isinstance(ref, bool) and 0 < ref <= MAX_ID:
+        return ref
+    return None
+
+def resolve_users(user_ids, usernames):
+    # id и username -> id одним IN-запросом на каждые BULK_CHUNK значений
+    by_id, by_name = {}, {}
+    ids = list({uid for uid in map(parse_user_id, user_ids) if uid is not None})
+    for start in range(0, len(ids), BULK_CHUNK):
+        rows = User.query.with_entities(User.id).filter(User.id.in_(ids[start:start + BULK_CHUNK]))
+        by_id.update((uid, uid) for (uid,) in rows)
+    names = list(set(usernames))
+    for start in range(0, len(names), BULK_CHUNK):
+        rows = User.query.with_entities(User.username, User.id).filter(User.username.in_(names[start:start + BULK_CHUNK]))
+        by_name.update(rows)
+    refs = [(ref, by_id.get(parse_user_id(ref))) for ref in user_ids]
+    refs += [(ref, by_name.get(ref)) for ref in usernames]
+    return refs
+
+def bulk_request(group_id):
+    group = Group.query.get_or_404(group_id)
+    if group.created_by != current_user.id:
+        return group, None, (jsonify({'error': 'Only group creator can manage members'}), 403)
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return group, None, (jsonify({'error': 'Expected a JSON object'}), 400)
+    user_ids, usernames = data.get('user_ids') or [], data.get('usernames') or []
+    if not isinstance(user_ids, list) or not isinstance(usernames, list):
+        return group, None, (jsonify({'error': 'user_ids and usernames must be lists'}), 400)
+    if len(user_ids) + len(usernames) > BULK_LIMIT:
+        return group, None, (jsonify({'error': f'At most {BULK_LIMIT} users per request'}), 400)
+    if not all(isinstance(ref, (int, str)) and not isinstance(ref, bool) for ref in user_ids):
+        return group, None, (jsonify({'error': 'user_ids must be integers or strings'}), 400)
+    if not all(isinstance(ref, str) for ref in usernames):
+        return group, None, (jsonify({'error': 'usernames must be strings'}), 400)
+    return group, resolve_users(user_ids, usernames), None
+
+@groups_bp.route('/<int:group_id>/members/add', methods=['POST'])
+@login_required
+def bulk_add_members(group_id):
+    group, refs, error = bulk_request(group_id)
+    if error:
+        return error
+
+    current = set(membership.member_ids(group_id))
+    results, to_add = [], []
+    for ref, user_id in refs:
+        if user_id is None:
+            status = 'not_found'
+        elif user_id in current:
+            status = 'already_member'
+        else:
+            status = 'added'
+            current.add(user_id)
+            to_add.append(user_id)
+        results.append({'ref': ref, 'user_id': user_id, 'status': status})
+
+    if to_add:
+        db.session.execute(GroupMember.__table__.insert(), [
+            {'user_id': user_id, 'group_id': group_id} for user_id in to_add
+        ])
+        inbox.add_group_members(to_add, group_id)
+        db.session.commit()
+        membership.invalidate(group_id, to_add)
+        message_bus.publish(membership.member_ids(group_id), {
+            'type': 'member_added',
+            'group_id': group.id,
+            'group_name': group.name,
+            'user_ids': to_add
+        })
+    return jsonify({'added': len(to_add), 'results': results})
+
+@groups_bp.route('/<int:group_id>/members/remove', methods=['POST'])
+@login_required
+def bulk_remove_members(group_id):
+    group, refs, error = bulk_request(group_id)
+    if error:
+        return error
+
+    current = membership.member_ids(group_id)
+    results, to_remove, removing = [], [], set()
+    for ref, user_id in refs:
+        if user_id is None:
+            status = 'not_found'
+        elif user_id not in current:
+            status = 'not_member'
+        else:
+            status = 'removed'
+            if user_id not in removing:
+                removing.add(user_id)
+                to_remove.append(user_id)
+        results.append({'ref': ref, 'user_id': user_id, 'status': status})
+
+    if to_remove:
+        for start in range(0, len(to_remove), BULK_CHUNK):
+            chunk = to_remove[start:start + BULK_CHUNK]
+            GroupMember.query.filter(GroupMember.group_id == group_id, GroupMember.user_id.in_(chunk)).delete(synchronize_session=False)
+            InboxEntry.query.filter(InboxEntry.group_id == group_id, InboxEntry.user_id.in_(chunk)).delete(synchronize_session=False)
+        db.session.commit()
+        membership.invalidate(group_id, to_remove)
+        message_bus.publish(current, {
+            'type': 'member_removed',
+            'group_id': group_id,
+            'user_ids': to_remove
+        })
+    return jsonify({'removed': len(to_remove), 'results': results})
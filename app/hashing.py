@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+
+class PoolBusy(Exception):
+    pass
+
+class HashPool:
+    # хэширование паролей в отдельных процессах: поток запроса ждёт результат,
+    # не держа GIL, и остальные запросы воркера продолжают обслуживаться
+    def __init__(self):
+        self.workers = 0
+        self.import_workers = 0
+        self.timeout = 30
+        self.executors = {}
+        self.pid = None
+        self.lock = threading.Lock()
+        self.slots = None
+        self.import_slot = threading.Lock()
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.workers = app.config['HASH_WORKERS']
+        self.import_workers = max(1, self.workers // 2)
+        self.timeout = app.config['HASH_TIMEOUT']
+        # одновременно workers задач считаются и HASH_QUEUE_LIMIT ждут, остальным - PoolBusy
+        self.slots = threading.BoundedSemaphore(self.workers + app.config['HASH_QUEUE_LIMIT'])
+
+    def get_executor(self, name='requests'):
+        # импорт считается в своём пуле: пачки паролей не встают в очередь перед входами пользователей
+        with self.lock:
+            if self.pid != os.getpid():
+                self.executors = {}
+                self.pid = os.getpid()
+            if name not in self.executors:
+                workers = self.workers if name == 'requests' else self.import_workers
+                # spawn: fork из многопоточного сервера может унести чужие блокировки
+                self.executors[name] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executors[name]
+
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PoolBusy()
+        try:
+            return self.get_executor().submit(fn, *args).result(timeout=self.timeout)
+        except FutureTimeout:
+            # для пользователя это та же перегрузка: форма с 503, а не 500
+            self.rejected += 1
+            raise PoolBusy()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password)
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def hash_many(self, passwords):
+        # массовый импорт: пароли раздаются пачками по процессам пула импорта, импорты идут по одному
+        if not self.workers:
+            return [generate_password_hash(p) for p in passwords]
+        if not self.import_slot.acquire(blocking=False):
+            self.rejected += 1
+            raise PoolBusy()
+        try:
+            chunksize = max(1, len(passwords) // (self.import_workers * 4))
+            return list(self.get_executor('import').map(generate_password_hash, passwords, chunksize=chunksize))
+        finally:
+            self.import_slot.release()
+
+hash_pool = HashPool()
@@ -0,0 +1,93 @@
+from flask import current_app, jsonify, request
+from flask_login import current_user
+from app import db, archive
+from app.models import User, Message, conversation_key
+from app.storage import id_arg
+
+def page_size():
+    return current_app.config['HISTORY_PAGE_SIZE']
+
+# scope - фильтр диалога; одинаковые колонки есть у Message и ArchiveSegment
+def dm_scope(user_a, user_b):
+    return {'conversation_key': conversation_key(user_a, user_b)}
+
+def group_scope(group_id):
+    return {'group_id': group_id}
+
+def latest(scope, limit=None):
+    return older(scope, None, limit)
+
+def older(scope, before_id, limit=None):
+    # keyset: берём limit + 1, чтобы узнать, есть ли что-то дальше
+    limit = limit or page_size()
+    query = Message.query.filter_by(**scope)
+    if before_id:
+        query = query.filter(Message.id < before_id)
+    rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        # горячая таблица кончилась - дочитываем из архивных сегментов
+        rows += archive.older(scope, rows[-1].id if rows else before_id, limit + 1 - len(rows))
+    has_more = len(rows) > limit
+    return rows[:limit][::-1], has_more
+
+def newer(scope, after_id, limit=None):
+    # клиент, отставший больше чем на страницу, догоняет повторными запросами с новым after_id
+    limit = limit or page_size()
+    rows = Message.query.filter_by(**scope).filter(Message.id > after_id).order_by(Message.id).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+def sender_names(messages):
+    # один запрос на страницу вместо User.query.get на каждое сообщение
+    ids = {m.sender_id for m in messages}
+    if not ids:
+        return {}
+    rows = User.query.with_entities(User.id, User.nickname).filter(User.id.in_(ids)).all()
+    return dict(rows)
+
+def serialize(messages):
+    names = sender_names(messages)
+    return [{
+        'id': m.id,
+        'content': m.content,
+        'sender_id': m.sender_id,
+        'sender_name': names.get(m.sender_id),
+        'timestamp': m.timestamp.isoformat(),
+        'is_mine': m.sender_id == current_user.id
+    } for m in messages]
+
+def validator(scope, after_id):
+    # max(id) и count по диапазону индекса - без загрузки и сериализации строк
+    last_id, count = Message.query.filter_by(**scope).filter(Message.id > after_id).with_entities(
+        db.func.max(Message.id), db.func.count(Message.id)
+    ).one()
+    return f'{current_user.id}-{after_id}-{last_id or 0}-{count}'
+
+def page_response(scope, args):
+    before_id = id_arg(args, 'before_id')
+    if before_id:
+        messages, has_more = older(scope, before_id)
+        response = jsonify({
+            'messages': serialize(messages),
+            'first_id': messages[0].id if messages else before_id,
+            'has_more': has_more
+        })
+        # старые страницы не меняются
+        response.cache_control.private = True
+        response.cache_control.max_age = 300
+        return response
+
+    after_id = id_arg(args, 'after_id', id_arg(args, 'since', 0))
+    etag = validator(scope, after_id)
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        messages, has_more = newer(scope, after_id)
+        response = jsonify({
+            'messages': serialize(messages),
+            'last_id': messages[-1].id if messages else after_id,
+            'has_more': has_more
+        })
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
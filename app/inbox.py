@@ -0,0 +1,170 @@
+from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models import User, Group, GroupMember, GroupSummary, Message, InboxEntry, conversation_key
+from app.storage import MAX_ID
+
+SNIPPET_LENGTH = 100
+UNREAD_LIMIT = 100
+
+def snippet(content):
+    return content[:SNIPPET_LENGTH]
+
+def summary(msg):
+    return {
+        'last_message_id': msg.id,
+        'last_sender_id': msg.sender_id,
+        'last_snippet': snippet(msg.content),
+        'last_at': msg.timestamp
+    }
+
+def upsert(model):
+    # INSERT ... ON CONFLICT: две одновременные первые записи в диалог не упираются в уникальный индекс
+    dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model)
+
+def record_message(msg):
+    # вызывается до commit, в той же транзакции, что и сама запись сообщения
+    values = summary(msg)
+    if msg.group_id:
+        # одна строка на группу: стоимость отправки не зависит от числа участников
+        rows, key, table = [dict(values, group_id=msg.group_id)], ['group_id'], GroupSummary.__table__
+    else:
+        rows = [dict(values, user_id=owner, peer_id=peer)
+                for owner, peer in {(msg.sender_id, msg.receiver_id), (msg.receiver_id, msg.sender_id)}]
+        key, table = ['user_id', 'peer_id'], InboxEntry.__table__
+    stmt = upsert(table)
+    # сводку не откатываем назад, если более новое сообщение успело записаться раньше
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=key,
+        set_={name: stmt.excluded[name] for name in values},
+        where=table.c.last_message_id < stmt.excluded.last_message_id
+    ), rows)
+
+def add_group_member(user_id, group_id):
+    add_group_members([user_id], group_id)
+
+def add_group_members(user_ids, group_id):
+    # сводка группы обновляется мимо ORM, поэтому читаем её запросом, а не из identity map
+    last_id = db.session.query(GroupSummary.last_message_id).filter_by(group_id=group_id).scalar()
+    # старая история группы для нового участника непрочитанной не считается
+    values = {'last_at': datetime.utcnow(), 'last_read_id': last_id or 0}
+    if user_ids:
+        # строка, уже вставленная параллельным запросом, остаётся как есть
+        db.session.execute(upsert(InboxEntry.__table__).on_conflict_do_nothing(index_elements=['user_id', 'group_id']), [
+            dict(values, user_id=user_id, group_id=group_id) for user_id in user_ids
+        ])
+
+def mark_read(user_id, peer_id=None, group_id=None, up_to=None):
+    # один UPDATE независимо от того, сколько сообщений было непрочитано
+    query = InboxEntry.query.filter_by(user_id=user_id)
+    if group_id:
+        query = query.filter_by(group_id=group_id)
+        last_id = db.select(GroupSummary.last_message_id).where(GroupSummary.group_id == group_id).scalar_subquery()
+    else:
+        query = query.filter_by(peer_id=peer_id)
+        last_id = InboxEntry.last_message_id
+    query = query.filter(InboxEntry.last_read_id < last_id)
+    if up_to is None:
+        return query.update({'last_read_id': last_id}, synchronize_session=False)
+    # отметка от клиента не уходит дальше последнего сообщения, иначе следующие не станут непрочитанными
+    return query.filter(InboxEntry.last_read_id < up_to).update({
+        'last_read_id': db.case((last_id < up_to, last_id), else_=up_to)
+    }, synchronize_session=False)
+
+def unread_counts(entries, limit=UNREAD_LIMIT):
+    # entries - пары (строка, id последнего сообщения диалога);
+    # один запрос на страницу: UNION ALL по диалогам, каждый - диапазон по индексу
+    # (conversation_key, id) / (group_id, id) не дальше limit строк
+    selects = []
+    for entry, last_message_id in entries:
+        if last_message_id <= entry.last_read_id:
+            continue
+        if entry.group_id:
+            query = Message.query.filter(Message.group_id == entry.group_id)
+        else:
+            query = Message.query.filter(Message.conversation_key == conversation_key(entry.user_id, entry.peer_id))
+        unread = query.filter(Message.id > entry.last_read_id, Message.sender_id != entry.user_id)
+        unread = unread.with_entities(Message.id).limit(limit).subquery()
+        selects.append(db.select(db.literal(entry.id).label('entry_id'), db.func.count().label('unread')).select_from(unread))
+    if not selects:
+        return {}
+    return dict(db.session.execute(db.union_all(*selects)).all())
+
+def parse_cursor(before):
+    # "last_message_id:id" последней строки предыдущей страницы; None, если курсор испорчен
+    parts = before.split(':')
+    if len(parts) != 2 or not all(part.isdecimal() and len(part) <= 19 and int(part) <= MAX_ID for part in parts):
+        return None
+    return int(parts[0]), int(parts[1])
+
+def page(user_id, cursor=None, limit=50):
+    # у групп время активности живёт в GroupSummary, поэтому порядок считается по выражению:
+    # строки пользователя берутся по ix_inbox_user_peer и сортируются во временном B-tree.
+    # Это все диалоги пользователя (сотни-тысячи), а не таблица целиком; индекс по
+    # (user_id, last_message_id) здесь не помогает, а держать ключ в строках участников
+    # значило бы снова обновлять по строке на каждого участника группы при отправке
+    activity = db.func.coalesce(GroupSummary.last_message_id, InboxEntry.last_message_id)
+    query = db.session.query(InboxEntry, GroupSummary).outerjoin(
+        GroupSummary, GroupSummary.group_id == InboxEntry.group_id
+    ).filter(InboxEntry.user_id == user_id)
+    if cursor:
+        last_message_id, entry_id = cursor
+        query = query.filter(
+            (activity < last_message_id) |
+            ((activity == last_message_id) & (InboxEntry.id < entry_id))
+        )
+    rows = query.order_by(activity.desc(), InboxEntry.id.desc()).limit(limit + 1).all()
+    # сводка диалога - строка группы, если она есть, иначе сама строка участника
+    entries = [(entry, group or entry) for entry, group in rows[:limit]]
+
+    peer_ids = {e.peer_id for e, _ in entries if e.peer_id}
+    group_ids = {e.group_id for e, _ in entries if e.group_id}
+    peers = dict(User.query.with_entities(User.id, User.nickname).filter(User.id.in_(peer_ids)).all()) if peer_ids else {}
+    groups = dict(Group.query.with_entities(Group.id, Group.name).filter(Group.id.in_(group_ids)).all()) if group_ids else {}
+
+    unread = unread_counts([(e, last.last_message_id) for e, last in entries])
+    tail = entries[-1] if entries else None
+    return {
+        'conversations': [{
+            'peer_id': e.peer_id,
+            'group_id': e.group_id,
+            'title': peers.get(e.peer_id) if e.peer_id else groups.get(e.group_id),
+            'last_message_id': last.last_message_id or None,
+            'last_sender_id': last.last_sender_id,
+            'last_snippet': last.last_snippet,
+            'last_at': last.last_at.isoformat() if last.last_at else None,
+            'unread': unread.get(e.id, 0)
+        } for e, last in entries],
+        'next_before': f'{tail[1].last_message_id}:{tail[0].id}' if tail else None,
+        'has_more': len(rows) > limit
+    }
+
+def rebuild():
+    # водяные знаки прочтения переживают пересборку, для диалогов без отметки историю считаем прочитанной
+    read_marks = {(e.user_id, e.peer_id, e.group_id): e.last_read_id for e in InboxEntry.query.yield_per(1000)}
+    InboxEntry.query.delete()
+    GroupSummary.query.delete()
+
+    last_ids = db.session.query(db.func.max(Message.id)).filter(
+        Message.conversation_key.isnot(None)
+    ).group_by(Message.conversation_key)
+    for msg in Message.query.filter(Message.id.in_(last_ids)).yield_per(1000):
+        values = summary(msg)
+        for owner, peer in {(msg.sender_id, msg.receiver_id), (msg.receiver_id, msg.sender_id)}:
+            db.session.add(InboxEntry(user_id=owner, peer_id=peer, last_read_id=read_marks.get((owner, peer, None), msg.id), **values))
+
+    group_last = dict(db.session.query(Message.group_id, db.func.max(Message.id)).filter(
+        Message.group_id.isnot(None)
+    ).group_by(Message.group_id).all())
+    last_messages = {m.group_id: m for m in Message.query.filter(Message.id.in_(group_last.values()))} if group_last else {}
+    for group_id, msg in last_messages.items():
+        db.session.add(GroupSummary(group_id=group_id, **summary(msg)))
+    for member in GroupMember.query.yield_per(1000):
+        last = last_messages.get(member.group_id)
+        read = read_marks.get((member.user_id, None, member.group_id), last.id if last else 0)
+        db.session.add(InboxEntry(user_id=member.user_id, group_id=member.group_id, last_read_id=read, last_at=member.joined_at))
+    db.session.commit()
+
+def is_empty():
+    return db.session.query(InboxEntry.id).first() is None
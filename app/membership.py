@@ -0,0 +1,56 @@
+from app.cache import TTLCache
+from app.events import subscribers
+from app.models import User, Group, GroupMember
+from app.storage import primary_read
+
+# group_id -> frozenset id участников, user_id -> список групп пользователя
+member_cache = TTLCache(maxsize=10000, ttl=300)
+user_groups_cache = TTLCache(maxsize=100000, ttl=300)
+
+def member_ids(group_id):
+    def load():
+        with primary_read():
+            return frozenset(
+                uid for (uid,) in GroupMember.query.with_entities(GroupMember.user_id).filter_by(group_id=group_id)
+            )
+    return member_cache.get_or_load(group_id, load)
+
+def is_member(user_id, group_id):
+    return user_id in member_ids(group_id)
+
+def member_count(group_id):
+    return len(member_ids(group_id))
+
+def user_groups(user_id):
+    def load():
+        with primary_read():
+            return [
+                {'id': gid, 'name': name} for gid, name in Group.query.with_entities(Group.id, Group.name).join(
+                    GroupMember
+                ).filter(GroupMember.user_id == user_id).order_by(Group.id)
+            ]
+    return user_groups_cache.get_or_load(user_id, load)
+
+def invalidate(group_id, user_ids=()):
+    member_cache.pop(group_id)
+    for user_id in user_ids:
+        user_groups_cache.pop(user_id)
+
+def on_membership_event(event):
+    invalidate(event['group_id'], event.get('user_ids') or [event['user_id']])
+
+# события приходят и из других воркеров через шину
+subscribers.on('member_added', on_membership_event)
+subscribers.on('member_removed', on_membership_event)
+
+def members_page(group_id, after_id=0, limit=50):
+    rows = User.query.with_entities(User.id, User.nickname).join(
+        GroupMember, GroupMember.user_id == User.id
+    ).filter(GroupMember.group_id == group_id, User.id > after_id).order_by(User.id).limit(limit + 1).all()
+    members = [{'id': r.id, 'nickname': r.nickname} for r in rows[:limit]]
+    return {
+        'members': members,
+        'next_after_id': members[-1]['id'] if members else after_id,
+        'has_more': len(rows) > limit,
+        'count': member_count(group_id)
+    }
@@ -0,0 +1,171 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from flask import current_app, g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+class RequestMetrics:
+    # счётчики живут в памяти процесса: при нескольких воркерах каждый отдаёт свои
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.in_flight = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.sql_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_endpoint = request.endpoint or 'unmatched'
+        g.sql_queries = []
+        with self.lock:
+            self.in_flight[g.metrics_endpoint] += 1
+
+    def after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def teardown_request(self, exc=None):
+        # teardown вызывается и после исключения; для SSE - когда ответ отдан, а не когда поток закрыт
+        if 'metrics_started' not in g:
+            return
+        elapsed = time.perf_counter() - g.metrics_started
+        endpoint = g.metrics_endpoint
+        queries = g.sql_queries
+        status = getattr(g, 'metrics_status', 500 if exc else 200)
+        sql_time = sum(duration for _, duration in queries)
+        with self.lock:
+            self.in_flight[endpoint] -= 1
+            self.requests[(endpoint, request.method, status)] += 1
+            self.latency[endpoint].observe(elapsed)
+            self.sql_time[endpoint].observe(sql_time)
+            self.statements[endpoint].observe(len(queries))
+
+        threshold = current_app.config['SLOW_REQUEST_MS']
+        if threshold and elapsed * 1000 >= threshold:
+            listing = '\n'.join(f'  {duration * 1000:.1f}ms {statement}' for statement, duration in queries)
+            current_app.logger.warning('slow request %s %s: %.1fms, %d queries, %.1fms in SQL\n%s',
+                                       request.method, request.path, elapsed * 1000, len(queries),
+                                       sql_time * 1000, listing)
+
+    def view(self):
+        # без METRICS_TOKEN метрики выключены: за прокси на той же машине remote_addr всегда локальный
+        token = current_app.config['METRICS_TOKEN']
+        if not token:
+            return Response('Not Found\n', status=404, mimetype='text/plain')
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+            return Response('Forbidden\n', status=403, mimetype='text/plain')
+        return Response('\n'.join(self.lines()) + '\n', mimetype='text/plain; version=0.0.4')
+
+    def lines(self):
+        with self.lock:
+            yield '# TYPE luffychat_requests_total counter'
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                yield f'luffychat_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}'
+            yield '# TYPE luffychat_requests_in_flight gauge'
+            for endpoint, count in sorted(self.in_flight.items()):
+                yield f'luffychat_requests_in_flight{{endpoint="{endpoint}"}} {count}'
+            for name, histograms in (('luffychat_request_duration_seconds', self.latency),
+                                     ('luffychat_request_sql_seconds', self.sql_time),
+                                     ('luffychat_request_sql_statements', self.statements)):
+                yield f'# TYPE {name} histogram'
+                for endpoint, histogram in sorted(histograms.items()):
+                    yield from histogram.lines(name, f'endpoint="{endpoint}"')
+        yield from component_lines()
+
+def component_lines():
+    # счётчики, которые компоненты уже ведут сами
+    from app import user_cache, membership
+    from app.bus import message_bus
+    from app.chat import directory_cache
+    from app.events import subscribers
+    from app.hashing import hash_pool
+    from app.ratelimit import limiter
+    from app.writer import message_writer
+
+    caches = {'user': user_cache, 'directory': directory_cache,
+              'group_members': membership.member_cache, 'user_groups': membership.user_groups_cache}
+    for name, kind, read in (('luffychat_cache_hits_total', 'counter', lambda c: c.hits),
+                             ('luffychat_cache_misses_total', 'counter', lambda c: c.misses),
+                             ('luffychat_cache_entries', 'gauge', len)):
+        yield f'# TYPE {name} {kind}'
+        for cache_name, cache in caches.items():
+            yield f'{name}{{cache="{cache_name}"}} {read(cache)}'
+
+    yield '# TYPE luffychat_rate_limit_total counter'
+    for outcome, counter in (('allowed', limiter.allowed), ('throttled', limiter.throttled)):
+        for name, count in sorted(counter.items()):
+            yield f'luffychat_rate_limit_total{{limit="{name}",outcome="{outcome}"}} {count}'
+    # только самые ограничиваемые пользователи, чтобы не раздувать число рядов
+    yield '# TYPE luffychat_rate_limit_throttled_user gauge'
+    for (name, user_id), count in limiter.top_throttled():
+        yield f'luffychat_rate_limit_throttled_user{{limit="{name}",user="{user_id}"}} {count}'
+
+    backend = message_bus.backend
+    if hasattr(backend, 'sent'):
+        yield '# TYPE luffychat_bus_datagrams_total counter'
+        yield f'luffychat_bus_datagrams_total{{outcome="sent"}} {backend.sent}'
+        yield f'luffychat_bus_datagrams_total{{outcome="dropped"}} {backend.dropped}'
+    yield '# TYPE luffychat_event_subscribers gauge'
+    yield f'luffychat_event_subscribers {subscribers.count()}'
+
+    yield '# TYPE luffychat_writer_batches_total counter'
+    yield f'luffychat_writer_batches_total {message_writer.batches}'
+    yield '# TYPE luffychat_writer_messages_total counter'
+    yield f'luffychat_writer_messages_total {message_writer.written}'
+    yield '# TYPE luffychat_writer_queue_size gauge'
+    yield f'luffychat_writer_queue_size {message_writer.queue.qsize()}'
+    yield '# TYPE luffychat_hash_pool_rejected_total counter'
+    yield f'luffychat_hash_pool_rejected_total {hash_pool.rejected}'
+
+request_metrics = RequestMetrics()
+
+# на уровне класса Engine: попадают и основная база, и реплика
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    # запросы фоновых потоков (пакетная запись, архиватор) к запросу не относятся
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries.append((statement, time.perf_counter() - started))
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # after_cursor_execute после ошибки не вызывается
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
@@ -0,0 +1,54 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from app import db
+from app.models import Message, User
+
+BACKFILL_BATCH = 10000
+
+def add_column(table, column, ddl):
+    columns = {c['name'] for c in inspect(db.engine).get_columns(table)}
+    if column in columns:
+        return False
+    db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    db.session.commit()
+    return True
+
+def add_conversation_key():
+    return add_column('message', 'conversation_key', 'VARCHAR(40)')
+
+def backfill_conversation_key():
+    # пачками, чтобы не держать блокировку на всю таблицу
+    total = 0
+    while True:
+        result = db.session.execute(text(
+            "UPDATE message SET conversation_key = CASE "
+            "WHEN sender_id < receiver_id THEN sender_id || ':' || receiver_id "
+            "ELSE receiver_id || ':' || sender_id END "
+            "WHERE id IN (SELECT id FROM message "
+            "WHERE conversation_key IS NULL AND receiver_id IS NOT NULL LIMIT :batch)"
+        ), {'batch': BACKFILL_BATCH})
+        db.session.commit()
+        if not result.rowcount:
+            return total
+        total += result.rowcount
+
+def create_indexes():
+    for index in Message.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    # индексы по выражению SQLAlchemy не отражает, checkfirst их не видит
+    for index in User.__table__.indexes:
+        db.session.execute(CreateIndex(index, if_not_exists=True))
+    db.session.commit()
+
+def backfill_inbox():
+    # таблица сводок новая или пустая, а сообщения уже есть
+    from app import inbox
+    if inbox.is_empty() and Message.query.first() is not None:
+        inbox.rebuild()
+
+def upgrade(force_backfill=False):
+    added = add_conversation_key()
+    if added or force_backfill:
+        backfill_conversation_key()
+    create_indexes()
+    backfill_inbox()
@@ -1,9 +1,16 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
-from app import db
+from sqlalchemy import event
+from app import db, user_cache
 
 class User(UserMixin, db.Model):
+    # поиск по префиксу без учёта регистра идёт диапазоном по этим индексам
+    __table_args__ = (
+        db.Index('ix_user_username_lower', db.func.lower(db.text('username'))),
+        db.Index('ix_user_nickname_lower', db.func.lower(db.text('nickname'))),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -15,13 +22,30 @@ class User(UserMixin, db.Model):
     messages_received = db.relationship('Message', foreign_keys='Message.receiver_id', backref='receiver')
     group_memberships = db.relationship('GroupMember', backref='user')
 
+def conversation_key(user_a, user_b):
+    # ключ личного диалога не зависит от того, кто отправитель
+    low, high = sorted((int(user_a), int(user_b)))
+    return f'{low}:{high}'
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, target):
+    # профиль изменился - следующий запрос перечитает пользователя из базы
+    user_cache.pop(target.id)
+
 class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_conversation_id', 'conversation_key', 'id'),
+        db.Index('ix_message_group_id_id', 'group_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
+    conversation_key = db.Column(db.String(40), nullable=True)
 
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -34,4 +58,54 @@ class GroupMember(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=False)
-    joined_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class GroupSummary(db.Model):
+    # последнее сообщение группы - одна строка на группу, а не на каждого участника
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), primary_key=True, autoincrement=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    last_snippet = db.Column(db.String(200), nullable=True)
+    last_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class InboxEntry(db.Model):
+    # сводка по диалогу для каждого участника, обновляется вместе с отправкой сообщения;
+    # у строк групп здесь только отметка прочтения, сводка берётся из GroupSummary
+    __table_args__ = (
+        db.Index('ix_inbox_user_peer', 'user_id', 'peer_id', unique=True),
+        db.Index('ix_inbox_user_group', 'user_id', 'group_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
+    last_message_id = db.Column(db.Integer, nullable=False, default=0)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    last_snippet = db.Column(db.String(200), nullable=True)
+    last_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # водяной знак прочтения: всё с id <= last_read_id считается прочитанным
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+
+class ArchiveSegment(db.Model):
+    # блок старых сообщений одного диалога, сжатый и дописанный в файл сегмента
+    __table_args__ = (
+        db.Index('ix_segment_conversation', 'conversation_key', 'last_id'),
+        db.Index('ix_segment_group', 'group_id', 'last_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_key = db.Column(db.String(40), nullable=True)
+    group_id = db.Column(db.Integer, nullable=True)
+    first_id = db.Column(db.Integer, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    offset = db.Column(db.Integer, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchiveEntry(db.Model):
+    # архивное сообщение -> его сегмент: поиск по message_search находит id, блок дочитывается отсюда
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    segment_id = db.Column(db.Integer, db.ForeignKey('archive_segment.id'), nullable=False)
@@ -0,0 +1,90 @@
+import csv
+import json
+from app import db
+from app.models import User
+from app.hashing import hash_pool
+
+FIELDS = ('username', 'email', 'nickname')
+LOOKUP_CHUNK = 500
+
+def parse_csv(lines):
+    return list(csv.DictReader(lines))
+
+def parse_ndjson(lines):
+    # битая строка становится ошибкой своей строки в validate, а не всего импорта
+    rows = []
+    for line in lines:
+        if line.strip():
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+    return rows
+
+def existing(column, values):
+    # набор уже занятых значений одним IN-запросом на каждые LOOKUP_CHUNK значений
+    values = list(values)
+    taken = set()
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        chunk = values[start:start + LOOKUP_CHUNK]
+        taken.update(v for (v,) in User.query.with_entities(column).filter(column.in_(chunk)))
+    return taken
+
+def validate(rows):
+    errors, accepted = [], []
+    seen = {field: set() for field in FIELDS}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({'row': index, 'username': None, 'error': 'row must be an object'})
+            continue
+        invalid = [f for f in FIELDS + ('password', 'password_hash') if row.get(f) is not None and not isinstance(row[f], str)]
+        if invalid:
+            errors.append({'row': index, 'username': None, 'error': f"invalid {', '.join(invalid)}: expected a string"})
+            continue
+        row = {k: (v or '').strip() if isinstance(v, str) else v for k, v in row.items()}
+        missing = [f for f in FIELDS if not row.get(f)]
+        if not row.get('password') and not row.get('password_hash'):
+            missing.append('password')
+        if missing:
+            errors.append({'row': index, 'username': row.get('username'), 'error': f"missing {', '.join(missing)}"})
+            continue
+        duplicate = next((f for f in FIELDS if row[f] in seen[f]), None)
+        if duplicate:
+            errors.append({'row': index, 'username': row['username'], 'error': f'duplicate {duplicate} in import'})
+            continue
+        for field in FIELDS:
+            seen[field].add(row[field])
+        accepted.append((index, row))
+
+    taken = {field: existing(getattr(User, field), seen[field]) for field in FIELDS}
+    valid = []
+    for index, row in accepted:
+        conflict = next((f for f in FIELDS if row[f] in taken[f]), None)
+        if conflict:
+            errors.append({'row': index, 'username': row['username'], 'error': f'{conflict} already exists'})
+        else:
+            valid.append(row)
+    return valid, errors
+
+def import_users(rows, batch_size=1000):
+    valid, errors = validate(rows)
+
+    to_hash = [row for row in valid if not row.get('password_hash')]
+    for row, pwhash in zip(to_hash, hash_pool.hash_many([row['password'] for row in to_hash])):
+        row['password_hash'] = pwhash
+
+    table = User.__table__
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        db.session.execute(table.insert(), [{
+            'username': row['username'],
+            'email': row['email'],
+            'nickname': row['nickname'],
+            'password_hash': row['password_hash']
+        } for row in batch])
+        db.session.commit()
+
+    from app.chat import directory_cache
+    directory_cache.clear()
+    errors.sort(key=lambda e: e['row'])
+    return {'created': len(valid), 'errors': errors}
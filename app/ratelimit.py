@@ -0,0 +1,76 @@
+import math
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from flask import current_app, jsonify
+from flask_login import current_user
+from app.cache import TTLCache
+
+DEFAULT_LIMITS = 'send=5/20,search=5/20,poll=2/20'
+
+def parse_limits(value):
+    # "send=5/20,search=5/20": маршрут=токенов в секунду/размер корзины
+    limits = {}
+    for item in value.split(','):
+        if item.strip():
+            name, budget = item.strip().split('=')
+            rate, burst = budget.split('/')
+            limits[name] = (float(rate), float(burst))
+    return limits
+
+class RateLimiter:
+    def __init__(self):
+        # корзины простаивающих пользователей вытесняются сами
+        self.buckets = TTLCache(maxsize=100000, ttl=600)
+        self.lock = threading.Lock()
+        self.allowed = Counter()
+        self.throttled = Counter()
+        # кого ограничивали: счётчики по (маршрут, пользователь), неактивные вытесняются
+        self.throttled_users = TTLCache(maxsize=10000, ttl=3600)
+
+    def hit(self, name, user_id, rate, burst):
+        # возвращает 0, если запрос пропущен, иначе через сколько секунд появится токен
+        key = (name, user_id)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets.set(key, (tokens - 1, now))
+                self.allowed[name] += 1
+                return 0
+            self.buckets.set(key, (tokens, now))
+            self.throttled[name] += 1
+            self.throttled_users.set(key, self.throttled_users.get(key, 0) + 1)
+            return (1 - tokens) / rate
+
+    def top_throttled(self, limit=20):
+        return sorted(self.throttled_users.items(), key=lambda item: -item[1])[:limit]
+
+limiter = RateLimiter()
+
+def check(name, user_id):
+    budget = current_app.config['RATE_LIMITS'].get(name)
+    if not budget:
+        return 0
+    return limiter.hit(name, user_id, *budget)
+
+def too_many(retry_after):
+    seconds = max(1, math.ceil(retry_after))
+    response = jsonify({'error': 'Too many requests', 'retry_after': seconds})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+def rate_limit(name):
+    # ставится под @login_required: корзина на пару (маршрут, пользователь)
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = check(name, current_user.id)
+            if retry_after:
+                return too_many(retry_after)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,162 @@
+from flask import current_app
+from sqlalchemy import text
+from app import db, archive
+from app.models import User, Message
+
+USER_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5("
+    "username, nickname, content='user', content_rowid='id', tokenize='trigram')",
+    'CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON "user" BEGIN '
+    "INSERT INTO user_search(rowid, username, nickname) VALUES (new.id, new.username, new.nickname); END",
+    'CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON "user" BEGIN '
+    "INSERT INTO user_search(user_search, rowid, username, nickname) "
+    "VALUES ('delete', old.id, old.username, old.nickname); END",
+    'CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF username, nickname ON "user" BEGIN '
+    "INSERT INTO user_search(user_search, rowid, username, nickname) "
+    "VALUES ('delete', old.id, old.username, old.nickname); "
+    "INSERT INTO user_search(rowid, username, nickname) VALUES (new.id, new.username, new.nickname); END",
+]
+
+MESSAGE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5("
+    "content, content='message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS message_search_ai AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_search(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_search_ad AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_search(message_search, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_search_au AFTER UPDATE OF content ON message BEGIN "
+    "INSERT INTO message_search(message_search, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO message_search(rowid, content) VALUES (new.id, new.content); END",
+]
+
+def fts_enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+def table_exists(name):
+    return db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': name}
+    ).first() is not None
+
+def install():
+    # FTS5 есть только в SQLite, на других базах остаётся поиск по префиксу.
+    # Только таблицы и триггеры: полный 'rebuild' на старте держал бы запись в каждом воркере,
+    # уже существующие строки индексирует flask search-rebuild
+    if not fts_enabled():
+        return
+    for name, source, statements in (('user_search', User, USER_INDEX), ('message_search', Message, MESSAGE_INDEX)):
+        created = not table_exists(name)
+        for statement in statements:
+            db.session.execute(text(statement))
+        if created and db.session.query(source.id).first():
+            current_app.logger.warning('%s created empty, run "flask search-rebuild" to index existing rows', name)
+    db.session.commit()
+
+def rebuild(name):
+    db.session.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+    if name == 'message_search':
+        # 'rebuild' читает только таблицу message, архивные сообщения добавляем из сегментов
+        for _, messages in archive.blocks():
+            index_archived(messages)
+    db.session.commit()
+
+def index_archived(messages):
+    # строки индекса без строки в message: совпадения по ним дочитываются через archive.load
+    if messages and fts_enabled() and table_exists('message_search'):
+        db.session.execute(text('INSERT INTO message_search(rowid, content) VALUES (:id, :content)'),
+                           [{'id': m.id, 'content': m.content} for m in messages])
+
+def rebuild_all():
+    install()
+    if fts_enabled():
+        rebuild('user_search')
+        rebuild('message_search')
+
+def fts_phrase(query):
+    return '"' + query.replace('"', '""') + '"'
+
+def prefix_candidates(query, limit):
+    # диапазон по индексам lower(username)/lower(nickname) вместо LIKE '%q%':
+    # у обычных уникальных индексов сравнение бинарное, и "lu" не находил "Luffy"
+    ids = []
+    needle = query.lower()
+    for column in (User.username, User.nickname):
+        key = db.func.lower(column)
+        rows = User.query.with_entities(User.id).filter(
+            key >= needle, key < needle + '\U0010ffff'
+        ).order_by(key).limit(limit).all()
+        ids += [uid for (uid,) in rows]
+    return ids
+
+def trigram_candidates(query, limit):
+    # без ORDER BY rank: bm25 для частых триграмм считался бы по всем совпадениям,
+    # а так FTS останавливается на первых limit строках
+    rows = db.session.execute(
+        text("SELECT rowid FROM user_search WHERE user_search MATCH :q LIMIT :limit"),
+        {'q': fts_phrase(query), 'limit': limit}
+    )
+    return [uid for (uid,) in rows]
+
+def find_users(query, exclude_id=None, limit=None):
+    query = query.strip()
+    limit = limit or current_app.config['SEARCH_LIMIT']
+    if not query:
+        return []
+
+    candidates = prefix_candidates(query, limit + 1)
+    # trigram-токенизатору нужно минимум 3 символа
+    if fts_enabled() and len(query) >= 3:
+        candidates += trigram_candidates(query, limit * 4)
+    order = {}
+    for position, uid in enumerate(candidates):
+        order.setdefault(uid, position)
+    order.pop(exclude_id, None)
+    if not order:
+        return []
+
+    users = User.query.filter(User.id.in_(order)).all()
+    needle = query.lower()
+
+    def rank(user):
+        names = (user.username.lower(), user.nickname.lower())
+        exact = needle in names
+        prefix = any(name.startswith(needle) for name in names)
+        return (not exact, not prefix, min(len(name) for name in names), order[user.id])
+
+    return sorted(users, key=rank)[:limit]
+
+def message_match(query):
+    # каждое слово - отдельная фраза, последнее ищем по префиксу
+    words = query.split()
+    if not words:
+        return None
+    return ' '.join(fts_phrase(w) for w in words[:-1]) + ' ' + fts_phrase(words[-1]) + '*'
+
+def find_messages(query, user_id, before_id=None, limit=None):
+    # только личные диалоги пользователя и группы, в которых он состоит
+    limit = limit or current_app.config['SEARCH_LIMIT']
+    match = message_match(query)
+    if not match:
+        return [], False
+    # архивные сообщения проверяются по диалогу их сегмента
+    rows = db.session.execute(text(
+        "SELECT s.rowid FROM message_search s "
+        "LEFT JOIN message m ON m.id = s.rowid "
+        "LEFT JOIN archive_entry e ON m.id IS NULL AND e.id = s.rowid "
+        "LEFT JOIN archive_segment a ON a.id = e.segment_id "
+        "WHERE message_search MATCH :match "
+        "AND (:before_id IS NULL OR s.rowid < :before_id) "
+        "AND (m.sender_id = :user_id AND m.receiver_id IS NOT NULL "
+        "OR m.receiver_id = :user_id "
+        "OR COALESCE(m.group_id, a.group_id) IN (SELECT group_id FROM group_member WHERE user_id = :user_id) "
+        "OR a.conversation_key LIKE :key_low OR a.conversation_key LIKE :key_high) "
+        "ORDER BY s.rowid DESC LIMIT :limit"
+    ), {'match': match, 'before_id': before_id, 'user_id': user_id, 'limit': limit + 1,
+        'key_low': f'{user_id}:%', 'key_high': f'%:{user_id}'})
+    ids = [mid for (mid,) in rows]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    messages = Message.query.filter(Message.id.in_(ids)).all() if ids else []
+    hot = {m.id for m in messages}
+    messages += archive.load([mid for mid in ids if mid not in hot])
+    messages.sort(key=lambda m: m.id, reverse=True)
+    return messages, has_more
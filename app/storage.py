@@ -0,0 +1,186 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import abort, current_app, g, jsonify, make_response, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from werkzeug.routing import IntegerConverter
+
+# именованные профили хранилища, выбираются через STORAGE_PROFILE
+PROFILES = {
+    'default': {},
+    'sqlite': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64000,
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {'connect_args': {'timeout': 30}},
+    },
+    'server': {
+        'engine_options': {
+            'pool_size': 20,
+            'max_overflow': 20,
+            'pool_timeout': 10,
+            'pool_recycle': 1800,
+            'pool_pre_ping': True,
+        },
+    },
+}
+
+# INTEGER в SQLite - 64 бита со знаком, больше драйвер не передаст (OverflowError)
+MAX_ID = 2 ** 63 - 1
+
+def id_arg(args, name, default=None):
+    # числовой курсор или id из запроса; нечисловое значение - как отсутствующее
+    value = args.get(name, type=int)
+    if value is None:
+        return default
+    if not -MAX_ID <= value <= MAX_ID:
+        abort(make_response(jsonify({'error': f'{name} is out of range'}), 400))
+    return value
+
+class IdConverter(IntegerConverter):
+    # <int:...> в маршрутах: id за пределами INTEGER просто не совпадают с маршрутом - 404
+    def __init__(self, map, *args, **kwargs):
+        kwargs.setdefault('max', MAX_ID)
+        super().__init__(map, *args, **kwargs)
+
+class RoutingSession(Session):
+    # в эндпоинтах с @replica_read чтение идёт в bind 'replica', запись всегда в основную базу
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            note_write()
+        elif bind is None and g and g.get('use_replica'):
+            replica = self._db.engines.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def note_write():
+    # после записи клиент какое-то время читает основную базу, пока реплика не догонит
+    if g:
+        g.wrote = True
+
+def remember_write(response):
+    if g.get('wrote'):
+        session['primary_until'] = time.time() + current_app.config['REPLICA_READ_AFTER_WRITE']
+    return response
+
+def replica_read(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = session.get('primary_until', 0) < time.time()
+        return view(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def primary_read():
+    # загрузчики общих кэшей читают основную базу: отставшая реплика осталась бы в кэше на весь TTL
+    if not g:
+        yield
+        return
+    previous = g.get('use_replica')
+    g.use_replica = False
+    try:
+        yield
+    finally:
+        g.use_replica = previous
+
+def configure(app):
+    # до db.init_app: параметры движка и bind реплики
+    name = app.config['STORAGE_PROFILE']
+    if name not in PROFILES:
+        raise ValueError(f'Unknown STORAGE_PROFILE: {name}')
+    profile = PROFILES[name]
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(profile.get('engine_options', {}))
+    app.config['SQLITE_PRAGMAS'] = dict(profile.get('pragmas', {}))
+    app.url_map.converters['int'] = IdConverter
+    if app.config['REPLICA_DATABASE_URL']:
+        app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['REPLICA_DATABASE_URL']}
+        app.after_request(remember_write)
+
+def pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f'PRAGMA {key}={value}')
+        cursor.close()
+    return set_pragmas
+
+def install_pragmas(app, db):
+    # после db.init_app: PRAGMA выполняются на каждом новом соединении SQLite
+    with app.app_context():
+        primary = db.engines[None]
+        replica = db.engines.get('replica')
+    if app.config['SQLITE_PRAGMAS'] and primary.dialect.name == 'sqlite':
+        event.listen(primary, 'connect', pragma_listener(app.config['SQLITE_PRAGMAS']))
+    # реплику только читаем: WAL и прочие настройки записи ей не нужны, а запись в неё - ошибка
+    if replica is not None and replica.dialect.name == 'sqlite':
+        event.listen(replica, 'connect', pragma_listener({'query_only': 'ON'}))
+
+def sqlite_path(engine):
+    return engine.url.database if engine.dialect.name == 'sqlite' else None
+
+def replica_files(app, db):
+    with app.app_context():
+        primary = sqlite_path(db.engines[None])
+        replica = db.engines.get('replica')
+        target = sqlite_path(replica) if replica is not None else None
+    if not primary or not target:
+        raise RuntimeError('replica sync needs SQLite primary and REPLICA_DATABASE_URL')
+    return primary, replica, target
+
+def sync_replica(app, db, wait=True, max_age=0):
+    # локальная реплика для тестов: согласованная копия файла через backup API SQLite.
+    # Воркеров несколько, копирует только взявший блокировку; копия моложе max_age секунд
+    # уже сделана соседом, её не повторяем
+    primary, replica, target = replica_files(app, db)
+    with open(target + '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        if max_age and os.path.exists(target) and time.time() - os.path.getmtime(target) < max_age:
+            return False
+        tmp = target + '.tmp'
+        source = sqlite3.connect(primary)
+        copy = sqlite3.connect(tmp)
+        try:
+            source.backup(copy)
+            # копия WAL-базы тоже в WAL; читателям реплики без записи нужен обычный журнал
+            copy.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            copy.close()
+            source.close()
+        # соединения пула открыты на старый файл: закрываем их до замены, а успевшие открыться
+        # между dispose и replace - сразу после
+        replica.dispose()
+        os.replace(tmp, target)
+        replica.dispose()
+    return True
+
+def start_replica_sync(app, db, interval):
+    _, replica, target = replica_files(app, db)
+
+    def loop():
+        seen = os.stat(target).st_ino
+        while True:
+            time.sleep(interval)
+            try:
+                sync_replica(app, db, wait=False, max_age=interval / 2)
+                # файл мог заменить сосед: наш пул всё ещё читает старый
+                current = os.stat(target).st_ino
+                if current != seen:
+                    replica.dispose()
+                    seen = current
+            except Exception:
+                app.logger.exception('replica sync failed')
+    threading.Thread(target=loop, name='replica-sync', daemon=True).start()
@@ -0,0 +1,97 @@
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from app import db
+from app.bus import message_bus
+
+log = logging.getLogger(__name__)
+
+class WriterBusy(Exception):
+    pass
+
+class BatchWriter:
+    # group commit: один поток пишет накопившиеся сообщения одной транзакцией,
+    # на пачку приходится один fsync и одна блокировка записи SQLite
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.queue = queue.Queue()
+        self.pid = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['SEND_BATCHING']
+        self.max_batch = app.config['SEND_BATCH_SIZE']
+        self.max_delay = app.config['SEND_BATCH_DELAY']
+        self.timeout = app.config['SEND_BATCH_TIMEOUT']
+
+    def start(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, name='message-writer', daemon=True).start()
+
+    def submit(self, sender_id, sender_name, content, receiver_id=None, group_id=None):
+        # ждём, пока пачка с нашим сообщением будет закоммичена
+        self.start()
+        future = Future()
+        self.queue.put(((sender_id, sender_name, content, receiver_id, group_id), future))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # писатель не успел за SEND_BATCH_TIMEOUT: для клиента это перегрузка (503), как PoolBusy
+            raise WriterBusy()
+
+    def collect(self):
+        batch = [self.queue.get()]
+        # без ожидания забираем всё, что накопилось, пока шёл прошлый commit;
+        # max_delay > 0 даёт пачкам подрасти ценой задержки
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get(timeout=self.max_delay) if self.max_delay else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def write(self, batch):
+        from app.chat import stage_message
+        try:
+            staged = [stage_message(*args) for args, future in batch]
+            db.session.commit()
+            return [(future, result) for (args, future), result in zip(batch, staged)]
+        except Exception:
+            db.session.rollback()
+            if len(batch) == 1:
+                raise
+        # одно плохое сообщение не должно ронять всю пачку - повторяем по одному
+        results = []
+        for item in batch:
+            try:
+                results += self.write([item])
+            except Exception as e:
+                log.exception('message write failed')
+                item[1].set_exception(e)
+        return results
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            with self.app.app_context():
+                try:
+                    results = self.write(batch)
+                except Exception as e:
+                    log.exception('message write failed')
+                    batch[0][1].set_exception(e)
+                    continue
+            self.batches += 1
+            self.written += len(results)
+            for future, (event, recipients) in results:
+                message_bus.publish(recipients, event)
+                future.set_result(event)
+
+message_writer = BatchWriter()
@@ -0,0 +1,86 @@
+# Задержка и пропускная способность доставки через SocketBus между процессами.
+# python bench/bus_benchmark.py --workers 4 --events 20000
+import argparse
+import multiprocessing
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.bus import SocketBus
+from app.events import subscribers
+
+USER_ID = 1
+
+def receiver(directory, events, ready, results):
+    bus = SocketBus(directory)
+    bus.start()
+    sink = subscribers.subscribe(USER_ID, queue.Queue())
+    ready.set()
+    latencies = []
+    deadline = None
+    while len(latencies) < events:
+        try:
+            event = sink.get(timeout=5)
+        except queue.Empty:
+            break
+        latencies.append(time.monotonic() - event['sent'])
+        deadline = time.monotonic()
+    results.put((len(latencies), latencies, deadline))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0, help='событий в секунду, 0 - без ограничения')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='luffychat-bus-')
+    results = multiprocessing.Queue()
+    procs = []
+    for _ in range(args.workers):
+        ready = multiprocessing.Event()
+        proc = multiprocessing.Process(target=receiver, args=(directory, args.events, ready, results))
+        proc.start()
+        ready.wait()
+        procs.append(proc)
+
+    bus = SocketBus(directory)
+    bus.start()
+    started = time.monotonic()
+    for i in range(args.events):
+        bus.publish([USER_ID], {'type': 'message', 'id': i, 'content': 'x' * 64, 'sent': time.monotonic()})
+        if args.rate:
+            time.sleep(1 / args.rate)
+    publish_time = time.monotonic() - started
+
+    received, latencies, finished = 0, [], started
+    for _ in procs:
+        count, worker_latencies, worker_finished = results.get()
+        received += count
+        latencies += worker_latencies
+        finished = max(finished, worker_finished or started)
+    for proc in procs:
+        proc.join()
+
+    expected = args.events * args.workers
+    print(f'workers: {args.workers}, events: {args.events}, deliveries: {received}/{expected} '
+          f'(dropped by sender: {bus.dropped})')
+    print(f'publish: {args.events / publish_time:.0f} events/s')
+    print(f'delivery: {received / (finished - started):.0f} deliveries/s')
+    if latencies:
+        print(f'latency ms: p50={percentile(latencies, 50) * 1000:.3f} '
+              f'p95={percentile(latencies, 95) * 1000:.3f} '
+              f'p99={percentile(latencies, 99) * 1000:.3f} '
+              f'mean={statistics.mean(latencies) * 1000:.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+# Общее для скриптов bench/: генерация имён и текста, перцентили.
+
+SYLLABLES = ['lu', 'ffy', 'zo', 'ro', 'na', 'mi', 'san', 'ji', 'us', 'opp', 'fra', 'nky', 'bro', 'ok',
+             'ace', 'sa', 'bo', 'han', 'cock', 'law', 'kid', 'shan', 'ks', 'mar', 'co', 'ki', 'ta', 'ne']
+WORDS = ['hi', 'hello', 'ship', 'sea', 'map', 'meat', 'treasure', 'storm', 'island', 'crew', 'ok', 'later',
+         'see', 'you', 'captain', 'sail', 'north', 'log', 'pose', 'fruit', 'devil', 'sword', 'cook', 'doctor']
+
+def make_name(rnd, shortest=2, longest=4):
+    return ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(shortest, longest)))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
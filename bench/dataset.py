@@ -0,0 +1,224 @@
+# Генератор синтетической базы для проверки запросов на объёме.
+# Пользователи, группы, личные диалоги и сообщения с перекосом активности по Zipf.
+# Рядом с базой пишется <db>.json с параметрами и "горячими"/"холодными" диалогами для query_benchmark.py.
+# python bench/dataset.py --db /tmp/big.db --users 100000 --groups 2000 --dm-pairs 300000 --messages 10000000
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.common import WORDS, make_name
+
+def zipf_cum_weights(count, s):
+    # вес k-го по популярности элемента ~ 1 / k^s
+    return list(itertools.accumulate(1 / (k + 1) ** s for k in range(count)))
+
+def make_content(rnd):
+    return ' '.join(rnd.choice(WORDS) for _ in range(int(rnd.paretovariate(1.5) * 3)))
+
+def insert(db, table, rows):
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+def fill_users(db, args, rnd, pwhash):
+    from app.models import User
+    created_at = datetime.utcnow() - timedelta(days=args.days)
+    rows = []
+    for i in range(args.users):
+        rows.append({'username': f'{make_name(rnd)}{i}', 'email': f'user{i}@example.com',
+                     'nickname': f'{make_name(rnd).capitalize()}_{i}', 'password_hash': pwhash,
+                     'created_at': created_at})
+        if len(rows) == args.batch:
+            insert(db, User.__table__, rows)
+            rows = []
+    insert(db, User.__table__, rows)
+    db.session.commit()
+    return [uid for (uid,) in db.session.query(User.id).order_by(User.id)]
+
+def fill_groups(db, args, rnd, user_ids, user_cum):
+    # размер группы - распределение Парето: много маленьких групп и немного огромных
+    from app.models import Group, GroupMember
+    groups = []
+    members_rows = []
+    created_at = datetime.utcnow() - timedelta(days=args.days)
+    for g in range(args.groups):
+        size = min(len(user_ids), args.group_max, max(2, int(rnd.paretovariate(1.2) * args.group_min)))
+        owner = rnd.choices(user_ids, cum_weights=user_cum)[0]
+        members = {owner} | set(rnd.sample(user_ids, size - 1))
+        groups.append({'name': f'{make_name(rnd).capitalize()} crew {g}', 'created_by': owner, 'created_at': created_at})
+        members_rows.append(sorted(members))
+    insert(db, Group.__table__, groups)
+    db.session.commit()
+    group_ids = [gid for (gid,) in db.session.query(Group.id).order_by(Group.id)]
+
+    rows = []
+    for gid, members in zip(group_ids, members_rows):
+        rows.extend({'user_id': uid, 'group_id': gid, 'joined_at': created_at} for uid in members)
+        if len(rows) >= args.batch:
+            insert(db, GroupMember.__table__, rows)
+            rows = []
+    insert(db, GroupMember.__table__, rows)
+    db.session.commit()
+    return list(zip(group_ids, members_rows))
+
+def make_pairs(args, rnd, user_ids, user_cum):
+    # собеседников тоже выбираем по Zipf: у популярных пользователей больше диалогов
+    pairs = set()
+    attempts = 0
+    while len(pairs) < args.dm_pairs and attempts < args.dm_pairs * 10:
+        attempts += 1
+        a, b = rnd.choices(user_ids, cum_weights=user_cum, k=2)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    pairs = sorted(pairs)
+    rnd.shuffle(pairs)
+    return pairs
+
+def fill_messages(db, args, rnd, pairs, groups):
+    from app.models import Message, conversation_key
+    pair_cum = zipf_cum_weights(len(pairs), args.zipf) if pairs else None
+    group_cum = zipf_cum_weights(len(groups), args.zipf) if groups else None
+    started_at = datetime.utcnow() - timedelta(days=args.days)
+    step = timedelta(days=args.days) / max(args.messages, 1)
+
+    table = Message.__table__
+    rows = []
+    written = 0
+    report_at = time.perf_counter()
+    for i in range(args.messages):
+        timestamp = started_at + step * i
+        if groups and (not pairs or rnd.random() < args.group_share):
+            gid, members = rnd.choices(groups, cum_weights=group_cum)[0]
+            rows.append({'content': make_content(rnd), 'timestamp': timestamp, 'sender_id': rnd.choice(members),
+                         'receiver_id': None, 'group_id': gid, 'conversation_key': None})
+        else:
+            a, b = rnd.choices(pairs, cum_weights=pair_cum)[0]
+            sender, receiver = (a, b) if rnd.random() < 0.5 else (b, a)
+            rows.append({'content': make_content(rnd), 'timestamp': timestamp, 'sender_id': sender,
+                         'receiver_id': receiver, 'group_id': None, 'conversation_key': conversation_key(a, b)})
+        if len(rows) == args.batch:
+            insert(db, table, rows)
+            db.session.commit()
+            written += len(rows)
+            rows = []
+            if time.perf_counter() - report_at > 10:
+                print(f'  messages: {written}/{args.messages}', flush=True)
+                report_at = time.perf_counter()
+    insert(db, table, rows)
+    db.session.commit()
+
+def mark_unread(db, args, rnd):
+    # inbox.rebuild считает всё прочитанным; часть диалогов делаем непрочитанными
+    from app.models import InboxEntry
+    ids = [eid for (eid,) in db.session.query(InboxEntry.id).order_by(InboxEntry.id)]
+    chosen = [eid for eid in ids if rnd.random() < args.unread]
+    for start in range(0, len(chosen), 500):
+        InboxEntry.query.filter(InboxEntry.id.in_(chosen[start:start + 500])).update(
+            {'last_read_id': 0}, synchronize_session=False)
+    db.session.commit()
+    return len(chosen)
+
+def without_message_indexes(db, load):
+    # вторичные индексы и триггеры полнотекстового поиска строим один раз после загрузки
+    from sqlalchemy import text
+    from app import search
+    from app.models import Message
+    indexes = list(Message.__table__.indexes)
+    for index in indexes:
+        index.drop(db.engine, checkfirst=True)
+    fts = search.fts_enabled() and search.table_exists('message_search')
+    if fts:
+        for name in ('message_search_ai', 'message_search_ad', 'message_search_au'):
+            db.session.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+        db.session.commit()
+    try:
+        load()
+    finally:
+        for index in indexes:
+            index.create(db.engine, checkfirst=True)
+        if fts:
+            for statement in search.MESSAGE_INDEX:
+                if 'TRIGGER' in statement:
+                    db.session.execute(text(statement))
+            search.rebuild('message_search')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', required=True, help='путь к файлу SQLite или URL базы')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--group-min', type=int, default=5, help='типичный размер группы')
+    parser.add_argument('--group-max', type=int, default=5000)
+    parser.add_argument('--dm-pairs', type=int, default=30000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--group-share', type=float, default=0.3, help='доля сообщений в группах')
+    parser.add_argument('--zipf', type=float, default=1.1, help='показатель перекоса активности')
+    parser.add_argument('--days', type=int, default=365, help='на сколько дней растянуть историю')
+    parser.add_argument('--unread', type=float, default=0.2, help='доля диалогов с непрочитанными')
+    parser.add_argument('--batch', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--meta', help='куда записать описание набора, по умолчанию <db>.json')
+    args = parser.parse_args()
+
+    url = args.db if '://' in args.db else 'sqlite:///' + os.path.abspath(args.db)
+    os.environ['DATABASE_URL'] = url
+    from werkzeug.security import generate_password_hash
+    from app import create_app, db, inbox
+
+    app = create_app()
+    rnd = random.Random(args.seed)
+    timings = {}
+    with app.app_context():
+        if db.session.execute(db.text('SELECT 1 FROM "user" LIMIT 1')).first():
+            sys.exit(f'{args.db} is not empty')
+
+        started = time.perf_counter()
+        user_ids = fill_users(db, args, rnd, generate_password_hash('password'))
+        # популярность не совпадает с порядком id
+        ranked_users = list(user_ids)
+        rnd.shuffle(ranked_users)
+        user_cum = zipf_cum_weights(len(ranked_users), args.zipf)
+        timings['users'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        groups = fill_groups(db, args, rnd, ranked_users, user_cum)
+        pairs = make_pairs(args, rnd, ranked_users, user_cum)
+        timings['groups_and_pairs'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        without_message_indexes(db, lambda: fill_messages(db, args, rnd, pairs, groups))
+        timings['messages'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        inbox.rebuild()
+        unread = mark_unread(db, args, rnd)
+        timings['inbox'] = time.perf_counter() - started
+
+    # первые элементы списков - самые активные по Zipf, середина - типичные
+    meta = {
+        'url': url,
+        'params': vars(args),
+        'counts': {'users': len(user_ids), 'groups': len(groups), 'dm_pairs': len(pairs),
+                   'messages': args.messages, 'unread_conversations': unread},
+        'timings_s': {k: round(v, 2) for k, v in timings.items()},
+        'hot_user': ranked_users[0],
+        'hot_pair': list(pairs[0]) if pairs else None,
+        'cold_pair': list(pairs[len(pairs) // 2]) if pairs else None,
+        'hot_group': {'id': groups[0][0], 'members': groups[0][1][:2]} if groups else None,
+        'cold_group': {'id': groups[len(groups) // 2][0], 'members': groups[len(groups) // 2][1][:2]} if groups else None,
+        'big_group': max(({'id': gid, 'size': len(m), 'members': m[:2]} for gid, m in groups), key=lambda g: g['size'], default=None),
+        'sample_users': rnd.sample(user_ids, min(100, len(user_ids)))
+    }
+    with open(args.meta or args.db.rsplit('/', 1)[-1] + '.json' if '://' in args.db else args.meta or args.db + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(json.dumps({k: meta[k] for k in ('counts', 'timings_s')}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+# Нагрузочный тест живого инстанса: headless-клиенты по мотивам archive/nohead/nohead.py.
+# Заводит синтетических пользователей, логинит их и гоняет смесь /send, опроса, поиска и групп.
+# Без --url поднимает локальный сервер на временной базе.
+# python bench/load_test.py --users 2000 --concurrency 64 --duration 60 --seed 1
+# python bench/load_test.py --url http://127.0.0.1:5000 --token $PROVISIONING_TOKEN --json report.json
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.common import WORDS, make_name, percentile
+
+DEFAULT_MIX = 'send=25,poll=40,search=10,group_view=5,group_poll=15,inbox=5'
+
+def parse_mix(spec):
+    # тот же формат, что у RATE_LIMITS: "send=25,poll=40"
+    mix = {}
+    for item in spec.split(','):
+        name, weight = item.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+class Client:
+    # один HTTP-клиент на поток, соединение переиспользуется, если сервер держит keep-alive
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return conn
+
+    def request(self, method, path, cookie=None, form=None, body=None, headers=None):
+        headers = dict(headers or {})
+        if cookie:
+            headers['Cookie'] = cookie
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn = self.connection()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self.local.conn = None
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+        return response.status, response.getheader('Set-Cookie'), data
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route, status, elapsed):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.statuses[route][status] += 1
+
+    def report(self, elapsed):
+        routes = {}
+        total = errors = throttled = 0
+        for route in sorted(self.latencies):
+            latencies = self.latencies[route]
+            statuses = self.statuses[route]
+            # 429 - штатный отказ лимитера, его считаем отдельно от ошибок
+            route_errors = sum(n for s, n in statuses.items() if s == 'error' or (s >= 400 and s != 429))
+            total += len(latencies)
+            errors += route_errors
+            throttled += statuses.get(429, 0)
+            routes[route] = {
+                'requests': len(latencies),
+                'rps': round(len(latencies) / elapsed, 1),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                'max_ms': round(max(latencies) * 1000, 2),
+                'errors': route_errors,
+                'statuses': {str(s): n for s, n in sorted(statuses.items(), key=str)}
+            }
+        return {
+            'duration_s': round(elapsed, 2),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 1),
+            'errors': errors,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'throttled': throttled,
+            'routes': routes
+        }
+
+class VirtualUser:
+    def __init__(self, index, username, nickname, seed):
+        self.index = index
+        self.username = username
+        self.nickname = nickname
+        self.rng = random.Random(seed * 1000003 + index)
+        self.id = None
+        self.cookie = None
+        self.peers = []
+        self.groups = []
+        self.last_ids = {}
+        self.lock = threading.Lock()
+
+def nickname(rng, index):
+    return make_name(rng, 2, 3).capitalize() + str(index)
+
+def provision(client, args, rng):
+    # пароль хэшируем один раз здесь, чтобы импорт не упирался в пул хэширования сервера
+    from werkzeug.security import generate_password_hash
+    pwhash = generate_password_hash(args.password)
+    prefix = f'load{args.seed}x'
+    rows = [{
+        'username': f'{prefix}{i}',
+        'email': f'{prefix}{i}@load.test',
+        'nickname': nickname(rng, i),
+        'password_hash': pwhash
+    } for i in range(args.users)]
+    for start in range(0, len(rows), 1000):
+        status, _, data = client.request('POST', '/auth/bulk', body=json.dumps(rows[start:start + 1000]), headers={
+            'Authorization': f'Bearer {args.token}',
+            'Content-Type': 'application/json'
+        })
+        if status != 200:
+            sys.exit(f'bulk import failed: {status} {data[:200]!r}')
+    return rows
+
+def login(client, user, password):
+    status, set_cookie, _ = client.request('POST', '/auth/login', form={'username': user.username, 'password': password})
+    if status != 302 or not set_cookie:
+        raise RuntimeError(f'login failed for {user.username}: {status}')
+    user.cookie = set_cookie.split(';', 1)[0]
+
+def resolve_ids(client, users):
+    # id берём из постраничного каталога; себя он не отдаёт, поэтому первого ищем глазами второго
+    by_name = {u.username: u for u in users}
+    for viewer in users[:2]:
+        after_id = 0
+        while True:
+            status, _, data = client.request('GET', f'/directory?after_id={after_id}', cookie=viewer.cookie)
+            page = json.loads(data)
+            for entry in page['users']:
+                if entry['username'] in by_name:
+                    by_name[entry['username']].id = entry['id']
+            if not page['has_more'] or all(u.id is not None for u in users):
+                break
+            after_id = page['next_after_id']
+        if all(u.id is not None for u in users):
+            break
+
+def create_groups(client, users, args, rng):
+    for g in range(args.groups):
+        owner = users[rng.randrange(len(users))]
+        client.request('POST', '/groups/create', cookie=owner.cookie, form={'name': f'load-group-{args.seed}-{g}'})
+        # только что созданная группа - самая свежая запись во входящих владельца
+        status, _, data = client.request('GET', '/inbox', cookie=owner.cookie)
+        group_id = next(c['group_id'] for c in json.loads(data)['conversations'] if c['group_id'])
+        members = rng.sample(users, min(args.group_size, len(users)))
+        client.request('POST', f'/groups/{group_id}/members/add', cookie=owner.cookie,
+                       body=json.dumps({'usernames': [m.username for m in members]}),
+                       headers={'Content-Type': 'application/json'})
+        for member in set(members) | {owner}:
+            member.groups.append(group_id)
+
+def assign_peers(users, args, rng):
+    # собеседники выбираются с перекосом: у первых пользователей диалогов больше
+    ids = [u.id for u in users]
+    weights = [1 / (i + 1) for i in range(len(users))]
+    for user in users:
+        peers = set(rng.choices(ids, weights, k=args.peers))
+        peers.discard(user.id)
+        user.peers = list(peers) or [ids[(user.index + 1) % len(ids)]]
+
+def act(client, stats, user, action, users):
+    rng = user.rng
+    if action == 'send':
+        if user.groups and rng.random() < 0.3:
+            route, form = 'POST /send (group)', {'group_id': rng.choice(user.groups)}
+        else:
+            route, form = 'POST /send', {'receiver_id': rng.choice(user.peers)}
+        form['content'] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        request = ('POST', '/send', form)
+    elif action == 'poll':
+        peer = rng.choice(user.peers)
+        route = 'GET /messages/<id>'
+        request = ('GET', f'/messages/{peer}?after_id={user.last_ids.get(("dm", peer), 0)}', None)
+    elif action == 'search':
+        target = users[rng.randrange(len(users))]
+        nick = target.nickname
+        route = 'GET /search'
+        request = ('GET', '/search?' + urlencode({'q': nick[:rng.randint(3, max(3, len(nick)))]}), None)
+    elif action == 'group_view' and user.groups:
+        route = 'GET /groups/<id>'
+        request = ('GET', f'/groups/{rng.choice(user.groups)}', None)
+    elif action == 'group_poll' and user.groups:
+        group_id = rng.choice(user.groups)
+        route = 'GET /groups/<id>/messages'
+        request = ('GET', f'/groups/{group_id}/messages?after_id={user.last_ids.get(("group", group_id), 0)}', None)
+    elif action == 'inbox':
+        route = 'GET /inbox'
+        request = ('GET', '/inbox', None)
+    else:
+        return
+
+    method, path, form = request
+    started = time.perf_counter()
+    try:
+        status, _, data = client.request(method, path, cookie=user.cookie, form=form)
+    except (OSError, http.client.HTTPException):
+        stats.record(route, 'error', time.perf_counter() - started)
+        return
+    stats.record(route, status, time.perf_counter() - started)
+
+    if status == 200 and route.endswith('/messages'):
+        user.last_ids[('group', group_id)] = json.loads(data).get('last_id', 0)
+    elif status == 200 and route == 'GET /messages/<id>':
+        user.last_ids[('dm', peer)] = json.loads(data).get('last_id', 0)
+
+def start_server(args):
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='luffychat-load-'), 'load.db'),
+               PROVISIONING_TOKEN=args.token,
+               SEND_BATCHING=os.getenv('SEND_BATCHING', '1'))
+    if not args.keep_limits:
+        env['RATE_LIMITS'] = ''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    # своя группа процессов: вместе с сервером гасим и процессы пула хэширования
+    process = subprocess.Popen([sys.executable, __file__, '--serve', str(port)], env=env, start_new_session=True)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit('local server did not start')
+
+def serve(port):
+    import logging
+    from app import create_app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = create_app()
+    app.run(host='127.0.0.1', port=port, threaded=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='адрес запущенного инстанса; без него поднимается локальный')
+    parser.add_argument('--token', default=os.getenv('PROVISIONING_TOKEN', 'load-test'))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--group-size', type=int, default=50)
+    parser.add_argument('--peers', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--think-time', type=float, default=0, help='пауза между действиями клиента, с')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--password', default='load-password')
+    parser.add_argument('--keep-limits', action='store_true', help='не отключать RATE_LIMITS у локального сервера')
+    parser.add_argument('--json', help='куда сохранить отчёт')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    process = None
+    if not args.url:
+        process, args.url = start_server(args)
+    try:
+        run(args)
+    finally:
+        if process:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+
+def run(args):
+    rng = random.Random(args.seed)
+    client = Client(args.url)
+    mix = parse_mix(args.mix)
+    actions, weights = list(mix), list(mix.values())
+
+    started = time.perf_counter()
+    users = [VirtualUser(i, row['username'], row['nickname'], args.seed) for i, row in enumerate(provision(client, args, rng))]
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(lambda u: login(client, u, args.password), users))
+    resolve_ids(client, users)
+    users = [u for u in users if u.id is not None]
+    assign_peers(users, args, rng)
+    create_groups(client, users, args, rng)
+    print(f'setup: {len(users)} users logged in, {args.groups} groups in {time.perf_counter() - started:.1f}s')
+
+    stats = Stats()
+    # каждый поток по кругу берёт пользователей из общей очереди
+    queue = list(users)
+    queue_lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker():
+        while time.perf_counter() < deadline:
+            with queue_lock:
+                user = queue.pop(0)
+            with user.lock:
+                act(client, stats, user, user.rng.choices(actions, weights)[0], users)
+            with queue_lock:
+                queue.append(user)
+            if args.think_time:
+                time.sleep(args.think_time)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report = stats.report(time.perf_counter() - started)
+    report['config'] = {k: v for k, v in vars(args).items() if k not in ('token', 'password', 'serve')}
+
+    print(f"{report['requests']} requests in {report['duration_s']}s: {report['throughput_rps']} req/s, "
+          f"error rate {report['error_rate'] * 100:.2f}%, throttled {report['throttled']}")
+    print(f"{'route':<28} {'req':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5}")
+    for route, r in report['routes'].items():
+        print(f"{route:<28} {r['requests']:>7} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} {r['errors']:>5}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
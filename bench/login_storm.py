@@ -0,0 +1,97 @@
+# Пропускная способность входа и задержка опроса во время массового логина.
+# Сравнивает хэширование в потоке запроса (HASH_WORKERS=0) и в пуле процессов.
+# python bench/login_storm.py --logins 200 --threads 16
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+def run(threads, logins):
+    from werkzeug.security import generate_password_hash
+    from app import create_app, db
+    from app.models import User
+    from app.hashing import hash_pool
+
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        pwhash = generate_password_hash('password')
+        db.session.add_all([User(username=f'u{i}', email=f'u{i}@x', nickname=f'U{i}', password_hash=pwhash)
+                            for i in range(threads + 1)])
+        db.session.commit()
+
+    poller = app.test_client()
+    with poller.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+    poll_latencies = []
+    storm_over = threading.Event()
+
+    def poll():
+        while not storm_over.is_set():
+            started = time.perf_counter()
+            poller.get('/messages/2?after_id=0')
+            poll_latencies.append(time.perf_counter() - started)
+            time.sleep(0.01)
+
+    statuses = []
+    per_thread = logins // threads
+
+    def storm(user_index):
+        client = app.test_client()
+        for _ in range(per_thread):
+            response = client.post('/auth/login', data={'username': f'u{user_index}', 'password': 'password'})
+            statuses.append(response.status_code)
+
+    poll_thread = threading.Thread(target=poll)
+    poll_thread.start()
+    time.sleep(0.2)
+    baseline = list(poll_latencies)
+
+    workers = [threading.Thread(target=storm, args=(i + 1,)) for i in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    storm_over.set()
+    poll_thread.join()
+    during = poll_latencies[len(baseline):]
+
+    mode = f'pool({hash_pool.workers})' if hash_pool.workers else 'inline'
+    ok = statuses.count(302)
+    print(f'{mode}: {ok / elapsed:.1f} logins/s ({ok}/{len(statuses)} ok, {statuses.count(503)} busy), '
+          f'poll p50={percentile(during, 50) * 1000:.1f}ms p99={percentile(during, 99) * 1000:.1f}ms '
+          f'(idle p50={percentile(baseline, 50) * 1000:.1f}ms)')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--child', action='store_true')
+    args = parser.parse_args()
+
+    if args.child:
+        run(args.threads, args.logins)
+        return
+    for workers in (0, args.workers):
+        env = dict(os.environ,
+                   DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='luffychat-login-'), 'bench.db'),
+                   HASH_WORKERS=str(workers), RATE_LIMITS='')
+        subprocess.run([sys.executable, __file__, '--child', '--threads', str(args.threads),
+                        '--logins', str(args.logins)], env=env, check=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# Микробенчмарки эндпоинтов app/chat.py и app/groups.py на базе из bench/dataset.py.
+# Настоящие view вызываются через test_client от имени пользователя из набора; для каждого случая -
+# задержка p50/p95/p99 и число SQL-запросов (вместе с загрузкой пользователя); кэши сбрасываются перед каждым вызовом.
+# Отправка и отметки прочтения остаются в базе - гоняйте на копии: cp /tmp/big.db /tmp/bench.db.
+# Массовое добавление в группу после каждого замера откатывается удалением тех же пользователей.
+# python bench/query_benchmark.py --db /tmp/bench.db --meta /tmp/big.db.json --repeat 200 --json results/$(git rev-parse --short HEAD).json
+# python bench/query_benchmark.py --db /tmp/bench.db --meta /tmp/big.db.json --compare results/old.json
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.common import percentile
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def middle_id(query):
+    # граница "середины истории" для страниц before_id
+    from app.models import Message
+    count = query.count()
+    row = query.with_entities(Message.id).order_by(Message.id).offset(count // 2).first()
+    return row[0] if row else None
+
+def last_id(query):
+    from app import db
+    from app.models import Message
+    return query.with_entities(db.func.max(Message.id)).scalar() or 0
+
+def build_cases(meta):
+    # имя, от чьего лица, запрос (метод, URL, аргументы test_client), запрос-откат или None
+    from app import db, history, membership
+    from app.models import User, Group, Message
+
+    hot_a, hot_b = meta['hot_pair']
+    cold_a, cold_b = meta['cold_pair']
+    hot_group, big_group = meta['hot_group'], meta['big_group']
+    hot_user = meta['hot_user']
+    reader, big_reader = hot_group['members'][0], big_group['members'][0]
+    owner = db.session.get(Group, hot_group['id']).created_by
+
+    hot_dm = Message.query.filter_by(**history.dm_scope(hot_a, hot_b))
+    cold_dm = Message.query.filter_by(**history.dm_scope(cold_a, cold_b))
+    group = Message.query.filter_by(**history.group_scope(hot_group['id']))
+    hot_dm_mid, group_mid = middle_id(hot_dm), middle_id(group)
+    hot_dm_last, cold_dm_last, group_last = last_id(hot_dm), last_id(cold_dm), last_id(group)
+    mid_user = User.query.with_entities(User.id).order_by(User.id).offset(User.query.count() // 2).first()[0]
+
+    samples = User.query.with_entities(User.nickname).filter(User.id.in_(meta['sample_users'])).all()
+    user_queries = itertools.cycle([u.nickname[:n] for u in samples for n in (3, 5)])
+    message_queries = itertools.cycle(['treasure', 'storm island', 'captain', 'devil fruit', 'nonexistentword'])
+    outsiders = User.query.with_entities(User.id, User.username).filter(
+        ~User.id.in_(membership.member_ids(hot_group['id']))).order_by(User.id).limit(100).all()
+    # половина по id, половина по username - оба пути resolve_users
+    bulk = {'json': {'user_ids': [u.id for u in outsiders[:50]], 'usernames': [u.username for u in outsiders[50:]]}}
+    members_url = f"/groups/{hot_group['id']}/members"
+
+    def get(url):
+        return lambda: ('GET', url, {})
+
+    def post(url, **kwargs):
+        return lambda: ('POST', url, kwargs)
+
+    return [
+        ('chat.index', hot_user, get('/'), None),
+        ('chat.directory_deep_page', hot_user, get(f'/directory?after_id={mid_user}'), None),
+        ('chat.search_users', hot_user, lambda: ('GET', f'/search?q={quote(next(user_queries))}', {}), None),
+        ('chat.chat_with_user_hot', hot_a, get(f'/chat/{hot_b}'), None),
+        ('chat.chat_with_user_cold', cold_a, get(f'/chat/{cold_b}'), None),
+        ('chat.messages_before_hot', hot_a, get(f'/messages/{hot_b}?before_id={hot_dm_mid}'), None),
+        ('chat.messages_before_cold', cold_a, get(f'/messages/{cold_b}?before_id={cold_dm_last + 1}'), None),
+        ('chat.messages_poll_empty', hot_a, get(f'/messages/{hot_b}?after_id={hot_dm_last}'), None),
+        ('chat.messages_poll_new', hot_a, get(f'/messages/{hot_b}?after_id={hot_dm_last - 20}'), None),
+        ('chat.send_dm', hot_a, post('/send', data={'receiver_id': hot_b, 'content': 'benchmark message'}), None),
+        ('chat.send_group_big', big_reader, post('/send', data={'group_id': big_group['id'], 'content': 'benchmark message'}), None),
+        ('chat.search_messages', hot_user, lambda: ('GET', f'/messages/search?q={quote(next(message_queries))}', {}), None),
+        ('chat.inbox_page', hot_user, get('/inbox'), None),
+        ('chat.mark_read', hot_a, post('/read', data={'peer_id': hot_b, 'last_id': hot_dm_last}), None),
+        ('groups.view_group_hot', reader, get(f"/groups/{hot_group['id']}"), None),
+        ('groups.messages_before', reader, get(f"/groups/{hot_group['id']}/messages?before_id={group_mid}"), None),
+        ('groups.messages_poll_empty', reader, get(f"/groups/{hot_group['id']}/messages?after_id={group_last}"), None),
+        ('groups.members_page_big', big_reader, get(f"/groups/{big_group['id']}/members"), None),
+        ('groups.bulk_add_100', owner, post(members_url + '/add', **bulk), post(members_url + '/remove', **bulk)),
+    ]
+
+@contextmanager
+def statement_counter(db):
+    from sqlalchemy import event
+    counter = {'statements': 0}
+
+    def count(*args):
+        counter['statements'] += 1
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+def clear_caches():
+    from app import user_cache, membership
+    from app.chat import directory_cache
+    for cache in (user_cache, directory_cache, membership.member_cache, membership.user_groups_cache):
+        cache.clear()
+
+def login(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+def run_case(app, db, name, user_id, make_request, undo, repeat, warmup, warm):
+    client = login(app, user_id)
+    timings, statements = [], []
+    with app.app_context():
+        for i in range(warmup + repeat):
+            if not warm:
+                clear_caches()
+            method, url, kwargs = make_request()
+            with statement_counter(db) as counter:
+                started = time.perf_counter()
+                response = client.open(url, method=method, **kwargs)
+                elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                sys.exit(f'{name}: {method} {url} -> {response.status_code}')
+            if undo:
+                method, url, kwargs = undo()
+                client.open(url, method=method, **kwargs)
+            if i >= warmup:
+                timings.append(elapsed)
+                statements.append(counter['statements'])
+    return {
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'statements': max(statements)
+    }
+
+def print_results(results, baseline):
+    print(f"{'case':<32} {'p50':>9} {'p95':>9} {'p99':>9} {'sql':>4}" + (f" {'p50 vs base':>12}" if baseline else ''))
+    for name, r in results.items():
+        line = f"{name:<32} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['statements']:>4}"
+        old = baseline.get(name) if baseline else None
+        if old and old['p50_ms']:
+            line += f" {(r['p50_ms'] / old['p50_ms'] - 1) * 100:>+11.1f}%"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', required=True, help='база из bench/dataset.py')
+    parser.add_argument('--meta', help='описание набора, по умолчанию <db>.json')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--warm', action='store_true', help='не сбрасывать кэши между вызовами')
+    parser.add_argument('--only', help='запустить случаи, имя которых содержит подстроку')
+    parser.add_argument('--json', help='куда сохранить результаты')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    with open(args.meta or args.db + '.json') as f:
+        meta = json.load(f)
+    os.environ['DATABASE_URL'] = args.db if '://' in args.db else 'sqlite:///' + os.path.abspath(args.db)
+    os.environ.setdefault('HASH_WORKERS', '0')
+    # лимиты частоты и журнал медленных запросов мешали бы замерам
+    os.environ['RATE_LIMITS'] = ''
+    os.environ.setdefault('SLOW_REQUEST_MS', '0')
+    from app import create_app, db
+
+    app = create_app()
+    results = {}
+    with app.app_context():
+        sqlite_version = db.session.execute(db.text('SELECT sqlite_version()')).scalar() if db.engine.dialect.name == 'sqlite' else None
+        cases = build_cases(meta)
+    for name, user_id, make_request, undo in cases:
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_case(app, db, name, user_id, make_request, undo, args.repeat, args.warmup, args.warm)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.json:
+        commit, dirty = git_revision()
+        report = {
+            'commit': commit,
+            'dirty': dirty,
+            'created_at': datetime.utcnow().isoformat(),
+            'python': sys.version.split()[0],
+            'sqlite': sqlite_version,
+            'dataset': {'params': meta['params'], 'counts': meta['counts']},
+            'options': {'repeat': args.repeat, 'warmup': args.warmup, 'warm': args.warm},
+            'results': results
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Пропускная способность /send: обычный commit на каждое сообщение против пакетной записи.
+# python bench/send_benchmark.py --threads 16 --messages 200
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def run(threads, messages):
+    from app import create_app, db
+    from app.models import User
+    from app.writer import message_writer
+
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.session.execute(db.text('PRAGMA journal_mode=WAL'))
+        db.session.add_all([User(username=f'u{i}', email=f'u{i}@x', nickname=f'U{i}', password_hash='x')
+                            for i in range(threads + 1)])
+        db.session.commit()
+
+    errors = []
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        for i in range(messages):
+            started = time.perf_counter()
+            response = client.post('/send', data={'receiver_id': threads + 1, 'content': f'message {i}'})
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+    workers = [threading.Thread(target=worker, args=(i + 1,)) for i in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    sent = threads * messages
+    mode = 'batched' if message_writer.enabled else 'direct'
+    print(f'{mode}: {sent / total:.0f} msg/s, p50={latencies[len(latencies) // 2] * 1000:.1f}ms '
+          f'p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, errors={len(errors)}'
+          + (f', batches={message_writer.batches} (avg {message_writer.written / max(message_writer.batches, 1):.1f})'
+             if message_writer.enabled else ''))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--mode', choices=['direct', 'batched'])
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.threads, args.messages)
+        return
+    # каждый режим в отдельном процессе со своей базой
+    for mode in ('direct', 'batched'):
+        env = dict(os.environ,
+                   DATABASE_URL='sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='luffychat-send-'), 'bench.db'),
+                   SEND_BATCHING='1' if mode == 'batched' else '0', RATE_LIMITS='')
+        subprocess.run([sys.executable, __file__, '--mode', mode,
+                        '--threads', str(args.threads), '--messages', str(args.messages)], env=env, check=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Латентность поиска пользователей (/search) на большой таблице user.
+# python bench/user_search_benchmark.py --users 1000000 --queries 2000
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SYLLABLES = ['lu', 'ffy', 'zo', 'ro', 'na', 'mi', 'san', 'ji', 'us', 'opp', 'fra', 'nky', 'bro', 'ok',
+             'ace', 'sa', 'bo', 'han', 'cock', 'law', 'kid', 'shan', 'ks', 'mar', 'co', 'ki', 'ta', 'ne']
+
+def make_name(rnd):
+    return ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4)))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def fill(db, count, rnd):
+    rows, batch = [], 50000
+    for i in range(count):
+        name = f'{make_name(rnd)}{i}'
+        rows.append({'username': name, 'email': f'{name}@example.com',
+                     'nickname': f'{make_name(rnd).capitalize()}_{i}', 'password_hash': 'x'})
+        if len(rows) == batch:
+            db.session.execute(db.text(
+                'INSERT INTO "user" (username, email, nickname, password_hash) '
+                'VALUES (:username, :email, :nickname, :password_hash)'), rows)
+            rows = []
+    if rows:
+        db.session.execute(db.text(
+            'INSERT INTO "user" (username, email, nickname, password_hash) '
+            'VALUES (:username, :email, :nickname, :password_hash)'), rows)
+    db.session.commit()
+
+def make_queries(rnd, count):
+    queries = []
+    for _ in range(count):
+        kind = rnd.random()
+        if kind < 0.4:
+            queries.append(make_name(rnd)[:rnd.randint(2, 5)])
+        elif kind < 0.8:
+            queries.append(rnd.choice(SYLLABLES) + rnd.choice(SYLLABLES))
+        else:
+            queries.append(''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, 6))))
+    return queries
+
+def measure(fn, queries):
+    timings = []
+    for q in queries:
+        started = time.perf_counter()
+        fn(q)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def report(name, timings):
+    print(f'{name}: p50={percentile(timings, 50) * 1000:.2f}ms p95={percentile(timings, 95) * 1000:.2f}ms '
+          f'p99={percentile(timings, 99) * 1000:.2f}ms max={max(timings) * 1000:.2f}ms')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--like-queries', type=int, default=50, help='сколько запросов прогнать старым LIKE')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='luffychat-search-'), 'bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    from app import create_app, db
+    from app.models import User
+    from app import search
+
+    rnd = random.Random(args.seed)
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        fill(db, args.users, rnd)
+        print(f'inserted {args.users} users in {time.perf_counter() - started:.1f}s')
+
+        queries = make_queries(rnd, args.queries)
+        search.find_users('warmup')
+        report('indexed', measure(search.find_users, queries))
+
+        def like(q):
+            User.query.filter(User.username.contains(q) | User.nickname.contains(q)).all()
+        report('LIKE %q% (old)', measure(like, queries[:args.like_queries]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+import os
+from app import create_app
+from app.gateway import run
+
+# процессы пула хэширования (spawn) заново импортируют главный модуль как __mp_main__,
+# приложение в них подниматься не должно
+if __name__ != '__mp_main__':
+    app = create_app()
+
+if __name__ == '__main__':
+    run(app, host='0.0.0.0', port=int(os.getenv('GATEWAY_PORT', 5001)))
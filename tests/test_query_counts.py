@@ -0,0 +1,104 @@
+# Число SQL-запросов на страницах истории не должно зависеть от числа отправителей и сообщений (нет N+1).
+# Сравниваем одни и те же маршруты на маленьком и большом диалоге; кэши сбрасываются перед каждым запросом.
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import event
+from app import create_app, db, user_cache, membership, inbox
+from app.chat import directory_cache, stage_message
+from app.models import User, Group, GroupMember
+
+SMALL, LARGE = 2, 30
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///' + str(tmp_path / 'test.db'))
+    monkeypatch.setenv('HASH_WORKERS', '0')
+    monkeypatch.setenv('RATE_LIMITS', '')
+    # обе истории помещаются в одну страницу, чтобы оба случая одинаково дочитывали архив
+    monkeypatch.setenv('HISTORY_PAGE_SIZE', '100')
+    app = create_app()
+    app.config['TESTING'] = True
+    yield app
+    clear_caches()
+
+def clear_caches():
+    for cache in (user_cache, directory_cache, membership.member_cache, membership.user_groups_cache):
+        cache.clear()
+
+def add_user(name):
+    user = User(username=name, email=f'{name}@example.com', nickname=name.capitalize(), password_hash='-')
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+def add_group(name, owner, senders):
+    group = Group(name=name, created_by=owner.id)
+    db.session.add(group)
+    db.session.flush()
+    for user in [owner] + senders:
+        db.session.add(GroupMember(user_id=user.id, group_id=group.id))
+        inbox.add_group_member(user.id, group.id)
+    # каждый участник пишет по два сообщения, отправители на странице перемешаны
+    for _ in range(2):
+        for user in senders:
+            stage_message(user.id, user.nickname, f'hello from {user.username}', group_id=group.id)
+    return group
+
+def add_dialog(viewer, peer, count):
+    for i in range(count):
+        sender, receiver = (viewer, peer) if i % 2 else (peer, viewer)
+        stage_message(sender.id, sender.nickname, f'message {i}', receiver_id=receiver.id)
+
+@pytest.fixture
+def data(app):
+    with app.app_context():
+        viewer = add_user('viewer')
+        small_peer, large_peer = add_user('smallpeer'), add_user('largepeer')
+        senders = [add_user(f'sender{i}') for i in range(LARGE)]
+        small_group = add_group('small', viewer, senders[:SMALL])
+        large_group = add_group('large', viewer, senders)
+        add_dialog(viewer, small_peer, SMALL)
+        add_dialog(viewer, large_peer, LARGE)
+        db.session.commit()
+        return {
+            'viewer': viewer.id,
+            'small': {'group': small_group.id, 'peer': small_peer.id},
+            'large': {'group': large_group.id, 'peer': large_peer.id}
+        }
+
+@contextmanager
+def statement_counter():
+    counter = {'statements': 0}
+
+    def count(*args):
+        counter['statements'] += 1
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+def count_statements(app, user_id, url):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    clear_caches()
+    with app.app_context(), statement_counter() as counter:
+        response = client.get(url)
+    assert response.status_code == 200, url
+    return counter['statements']
+
+@pytest.mark.parametrize('url', [
+    '/groups/{group}/messages',
+    '/groups/{group}/messages?after_id=0',
+    '/groups/{group}/messages?before_id=1000000',
+    '/groups/{group}',
+    '/messages/{peer}',
+    '/messages/{peer}?before_id=1000000',
+    '/chat/{peer}'
+])
+def test_statement_count_does_not_grow(app, data, url):
+    small = count_statements(app, data['viewer'], url.format(**data['small']))
+    large = count_statements(app, data['viewer'], url.format(**data['large']))
+    assert small == large